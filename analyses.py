@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+
+import guardrail
+from grid import required_portfolio_grid, withdrawal_grid
+from instrument import get_tracer
+from policies import ProbabilityGuardrail, compare_policies, make_policies, make_policy, policy_names, run_policies
+from result_cache import cache_key
+from results_store import average_withdrawals
+from sketch import QuantileSketch
+
+# Library versions of the four analyses the scripts run. Each is a function
+# of a Scenario (see scenario.py) with no module-level state, so many
+# scenarios can be run in one long-lived process (see main.py).
+
+# Percentiles reported by the percentile tables (0% to 100% in 1% increments)
+default_percentiles = np.arange(0, 101, 1)
+
+
+# Function to calculate the CAGR percentiles of the simulated returns (log.py)
+def cagr_percentiles(scenario, percentiles=default_percentiles):
+    cagr_sketch = QuantileSketch()
+    starts = range(0, scenario.n_simulations, scenario.chunk_size)
+    chunk_seeds = np.random.SeedSequence(scenario.seed).spawn(len(starts))
+    generator = scenario.return_generator()
+
+    for start, chunk_seed in zip(starts, chunk_seeds):
+        n_chunk = min(scenario.chunk_size, scenario.n_simulations - start)
+        returns = generator.generate(scenario.n_years, n_chunk, np.random.default_rng(chunk_seed))
+
+        # CAGR of $1 invested over the whole horizon
+        ending_values = np.prod(1 + returns, axis=0)
+        cagr_sketch.update(ending_values ** (1 / scenario.n_years) - 1)
+
+    return pd.DataFrame({
+        'Percentile (%)': percentiles,
+        f'{scenario.n_years}-Year CAGR': cagr_sketch.percentiles(percentiles),
+    })
+
+
+# Function to find the withdrawal for each target success rate (sim1.py)
+def optimal_withdrawal(scenario, target_percentages=None):
+    targets = list(scenario.target_percentages if target_percentages is None else target_percentages)
+    grid = withdrawal_grid(scenario.returns(), scenario.initial_portfolio, targets, [scenario.n_years])
+    return grid.loc[scenario.n_years].to_dict()
+
+
+# Function to find the portfolio needed for each target success rate (sim2.py)
+def required_portfolio(scenario, target_percentages=None, withdrawal_amount=None):
+    targets = list(scenario.target_percentages if target_percentages is None else target_percentages)
+    withdrawal_amount = scenario.withdrawal_amount if withdrawal_amount is None else withdrawal_amount
+    grid = required_portfolio_grid(scenario.returns(), [withdrawal_amount], targets, [scenario.n_years])
+    return grid.loc[scenario.n_years][withdrawal_amount].to_dict()
+
+
+# Function to run the guardrail withdrawal simulation (sim3.py) under the
+# scenario's withdrawal policy
+# Returns the initial withdrawal and the CAGR and average-withdrawal percentiles
+def guardrail_simulation(scenario, percentiles=default_percentiles):
+    tracer = get_tracer()
+    target = scenario.target_success_rate
+    adjust = make_policy(scenario.withdrawal_policy, scenario, scenario.policy_rate)
+    with tracer.stage('initial_withdrawal'):
+        if isinstance(adjust, ProbabilityGuardrail):
+            initial_withdrawal = optimal_withdrawal(scenario, [target])[target]
+        else:
+            initial_withdrawal = adjust.initial_withdrawal(scenario.initial_portfolio, scenario.n_years)
+
+    if isinstance(adjust, ProbabilityGuardrail):
+        with tracer.stage('success_surface'):
+            adjust.load_surface()
+
+    cagr_sketch = QuantileSketch()
+    withdrawal_sketch = QuantileSketch()
+    for start, stop, withdrawal, chunk_seed in guardrail.make_chunks(
+        scenario, initial_withdrawal, scenario.n_simulations
+    ):
+        with tracer.stage('simulations'):
+            results = guardrail.run_batched_simulations(
+                scenario, withdrawal, stop - start, adjust, np.random.default_rng(chunk_seed)
+            )
+        cagr_sketch.update(results['CAGR'])
+        withdrawal_sketch.update(average_withdrawals(results))
+
+    return {
+        'initial_withdrawal': initial_withdrawal,
+        'cagr_percentiles': pd.DataFrame({
+            'Percentile': percentiles,
+            'CAGR': cagr_sketch.percentiles(percentiles) * 100,  # Convert to percentage
+        }),
+        'withdrawal_percentiles': pd.DataFrame({
+            'Percentile': percentiles,
+            'Average Withdrawal': withdrawal_sketch.percentiles(percentiles),
+        }),
+    }
+
+
+# Function to compare withdrawal policies on the same simulated returns: the
+# chunk streams guardrail_simulation runs on, kept apart from the scenario
+# bank matrix the probability rule solves its initial withdrawal on
+# policies: names, or label -> rate or options (see policies.policy_specs);
+# defaults to the scenario's compared_policies, else every policy in
+# policies.py with its default rate
+# Returns one row per policy: success rate, average-withdrawal percentiles,
+# median lowest withdrawal and median ending balance
+def policy_comparison(scenario, policies=None):
+    if policies is None:
+        policies = policy_names if scenario.compared_policies is None else scenario.compared_policies
+    policies = make_policies(policies, scenario)
+    generator = scenario.return_generator()
+
+    chunk_results = []
+    with get_tracer().stage('policies'):
+        for start, stop, _, chunk_seed in guardrail.make_chunks(scenario, None, scenario.n_simulations):
+            returns = generator.generate(scenario.n_years, stop - start, np.random.default_rng(chunk_seed))
+            chunk_results.append(run_policies(scenario, policies, returns=returns))
+
+    results = {
+        name: {field: np.concatenate([chunk[name][field] for chunk in chunk_results]) for field in chunk_results[0][name]}
+        for name in policies
+    }
+    return compare_policies(results)
+
+
+# Analyses by name, as used in scenario batches
+analyses = {
+    'cagr_percentiles': cagr_percentiles,
+    'optimal_withdrawal': optimal_withdrawal,
+    'required_portfolio': required_portfolio,
+    'guardrail_simulation': guardrail_simulation,
+    'policy_comparison': policy_comparison,
+}
+
+
+# Function to run an analysis by name, reusing a stored result from cache (a
+# result_cache.ResultCache) when the scenario and arguments have been run before
+# Scenarios without a seed draw fresh returns and are never cached.
+def run_analysis(name, scenario, cache=None, **arguments):
+    if name not in analyses:
+        raise ValueError(f"Unknown analysis: {name!r} (choose from {', '.join(analyses)})")
+    if cache is None or scenario.seed is None:
+        return analyses[name](scenario, **arguments)
+    return cache.get_or_compute(cache_key(name, scenario, **arguments), lambda: analyses[name](scenario, **arguments))
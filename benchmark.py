@@ -0,0 +1,412 @@
+import argparse
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+# Benchmark suite and performance regression harness for the simulation kernels.
+#
+# Every case is timed in a fresh process across a matrix of path counts,
+# horizons and worker counts, recording throughput (paths * years / second)
+# and peak RSS. Each run is appended to a JSON history and compared with a
+# stored baseline; cases slower than the baseline by more than --tolerance are
+# flagged. Equivalence checks then confirm on fixed seeds that the fast engines
+# give the same (or statistically equivalent) success rates and percentiles as
+# the original scalar loops.
+#
+#   python benchmark.py                 # default matrix + equivalence checks
+#   python benchmark.py --quick         # small matrix for a smoke run
+#   python benchmark.py --save-baseline # store this run as the baseline
+
+history_file = 'benchmark_history.json'
+baseline_file = 'benchmark_baseline.json'
+
+# Case matrix
+default_paths = [1000, 10000, 100000]
+default_years = [30, 40]
+default_workers = [1, 2, 4]
+quick_paths = [1000, 5000]
+quick_years = [30]
+quick_workers = [1, 2]
+
+
+# Function with the original scalar loop from sim1.py/sim2.py/sim3.py (the reference)
+def reference_ending_balances(returns, initial_balance, withdrawal_amount):
+    ending_values = []
+    for simulation in range(returns.shape[1]):
+        portfolio_value = initial_balance
+        for year in range(returns.shape[0]):
+            portfolio_value -= withdrawal_amount
+            if portfolio_value <= 0:
+                portfolio_value = 0
+                break
+            portfolio_value *= (1 + returns[year, simulation])
+        ending_values.append(portfolio_value)
+    return np.array(ending_values)
+
+
+def reference_success_rate(returns, initial_balance, withdrawal_amount):
+    return np.mean(reference_ending_balances(returns, initial_balance, withdrawal_amount) > 0) * 100
+
+
+# Function to configure sim3's module parameters for a benchmark case
+def configure_sim3(n_paths, n_years, **overrides):
+    import sim3
+    sim3.n_years_total = n_years
+    sim3.n_simulations = n_paths
+    sim3.success_surface = None
+    for name, value in overrides.items():
+        setattr(sim3, name, value)
+    return sim3
+
+
+def fixed_returns(n_paths, n_years, seed=0):
+    from scenario import Scenario
+    return Scenario(n_years=n_years, n_simulations=n_paths, seed=seed).returns()
+
+
+# Benchmark cases: each takes (n_paths, n_years, workers) and returns the
+# function to time. Kernels run with one worker; the pool case varies workers.
+
+def case_reference_loop(n_paths, n_years, workers):
+    returns = fixed_returns(n_paths, n_years)
+    return lambda: reference_success_rate(returns, 1000000, 46000)
+
+
+def case_simulate_withdrawals(n_paths, n_years, workers):
+    from engine import success_rate
+    returns = fixed_returns(n_paths, n_years)
+    return lambda: success_rate(returns, 1000000, 46000)
+
+
+def case_annuity_factors(n_paths, n_years, workers):
+    from engine import annuity_factor_table
+    returns = fixed_returns(n_paths, n_years)
+    return lambda: annuity_factor_table(returns)
+
+
+def case_calculate_success_rate(n_paths, n_years, workers):
+    # sim3's inner simulation, drawing fresh returns on every call
+    sim3 = configure_sim3(n_paths, n_years, n_inner_simulations=n_paths, seed=None)
+    return lambda: sim3.calculate_success_rate(1000000, 46000, n_years)
+
+
+def case_run_single_simulation(n_paths, n_years, workers):
+    sim3 = configure_sim3(n_paths, n_years)
+    sim3.get_success_surface()
+    rng = np.random.default_rng(0)
+    return lambda: [sim3.run_single_simulation((simulation, 46000), rng) for simulation in range(n_paths)]
+
+
+def case_guardrail_batched(n_paths, n_years, workers):
+    sim3 = configure_sim3(n_paths, n_years)
+    sim3.get_success_surface()
+    return lambda: sim3.run_batched_simulations(46000, n_paths, np.random.default_rng(0))
+
+
+def case_guardrail_pool(n_paths, n_years, workers):
+    sim3 = configure_sim3(n_paths, n_years)
+    sim3.get_success_surface()
+    chunks = sim3.make_chunks(46000, n_paths)
+
+    def run():
+        with mp.Pool(processes=workers) as pool:
+            return pool.map(sim3.run_batched_chunk, chunks)
+    return run
+
+
+def case_generator(model, dtype=np.float64):
+    def case(n_paths, n_years, workers):
+        from generators import BootstrapReturns, make_generator
+        if model == 'bootstrap':
+            generator = BootstrapReturns(np.random.default_rng(0).normal(0.0628, 0.1272, 100))
+        else:
+            generator = make_generator(model, 0.0628, 0.1272)
+        out = np.empty((n_years, n_paths), dtype=dtype)
+        rng = np.random.default_rng(0)
+        return lambda: generator.generate(n_years, n_paths, rng, dtype, out)
+    return case
+
+
+def case_solve(analysis):
+    def case(n_paths, n_years, workers):
+        from analyses import analyses
+        from scenario import Scenario
+        scenario = Scenario(n_years=n_years, n_simulations=n_paths)
+        return lambda: analyses[analysis](scenario)
+    return case
+
+
+# name -> (case, max paths, varies with workers)
+cases = {
+    'reference_loop': (case_reference_loop, 10000, False),
+    'simulate_withdrawals': (case_simulate_withdrawals, None, False),
+    'annuity_factors': (case_annuity_factors, None, False),
+    'calculate_success_rate': (case_calculate_success_rate, None, False),
+    'run_single_simulation': (case_run_single_simulation, 5000, False),
+    'guardrail_batched': (case_guardrail_batched, None, False),
+    'guardrail_pool': (case_guardrail_pool, None, True),
+    'returns_normal': (case_generator('normal'), None, False),
+    'returns_normal_float32': (case_generator('normal', np.float32), None, False),
+    'returns_lognormal': (case_generator('lognormal'), None, False),
+    'returns_student_t': (case_generator('student_t'), None, False),
+    'returns_bootstrap': (case_generator('bootstrap'), None, False),
+    'returns_regime': (case_generator('regime'), None, False),
+    'optimal_withdrawal': (case_solve('optimal_withdrawal'), None, False),
+    'required_portfolio': (case_solve('required_portfolio'), None, False),
+    'cagr_percentiles': (case_solve('cagr_percentiles'), None, False),
+    'guardrail_simulation': (case_solve('guardrail_simulation'), None, False),
+}
+
+
+def case_id(name, n_paths, n_years, workers):
+    return f"{name}/paths={n_paths}/years={n_years}/workers={workers}"
+
+
+# Function run in a fresh process: time one case and report its peak RSS
+def run_case(name, n_paths, n_years, workers, repeats, queue):
+    import surface
+    surface.cache_dir = tempfile.mkdtemp(prefix='mclarlo-bench-')
+
+    try:
+        function = cases[name][0](n_paths, n_years, workers)
+        function()  # Warm-up (surface build, scenario bank)
+        timings = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start_time)
+
+        seconds = min(timings)
+        queue.put({
+            'case': case_id(name, n_paths, n_years, workers),
+            'name': name, 'n_paths': n_paths, 'n_years': n_years, 'workers': workers,
+            'seconds': seconds,
+            'throughput': n_paths * n_years / seconds,
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        })
+    except Exception as error:
+        queue.put({'case': case_id(name, n_paths, n_years, workers), 'error': repr(error)})
+
+
+def run_benchmarks(names, paths, years, workers, repeats):
+    context = mp.get_context('spawn')
+    results = []
+    for name in names:
+        _, max_paths, varies_with_workers = cases[name]
+        for n_paths, n_years, n_workers in itertools.product(paths, years, workers if varies_with_workers else [1]):
+            if max_paths is not None and n_paths > max_paths:
+                continue
+
+            queue = context.Queue()
+            process = context.Process(target=run_case, args=(name, n_paths, n_years, n_workers, repeats, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+
+            results.append(result)
+            if 'error' in result:
+                print(f"{result['case']:<60} ERROR {result['error']}")
+            else:
+                print(f"{result['case']:<60} {result['seconds']:>9.4f}s "
+                      f"{result['throughput']:>14,.0f} path-years/s {result['peak_rss_mb']:>8.1f} MB")
+    return results
+
+
+# Two-sample Kolmogorov-Smirnov test: True if the samples are consistent with
+# one distribution at significance level alpha
+def same_distribution(sample_a, sample_b, alpha=0.001):
+    sample_a, sample_b = np.sort(sample_a), np.sort(sample_b)
+    values = np.concatenate([sample_a, sample_b])
+    cdf_a = np.searchsorted(sample_a, values, side='right') / len(sample_a)
+    cdf_b = np.searchsorted(sample_b, values, side='right') / len(sample_b)
+    statistic = np.max(np.abs(cdf_a - cdf_b))
+    n, m = len(sample_a), len(sample_b)
+    critical = math.sqrt(-math.log(alpha / 2) / 2) * math.sqrt((n + m) / (n * m))
+    return statistic <= critical, statistic, critical
+
+
+# Equivalence checks of the fast engines against the reference loops on fixed seeds
+def run_equivalence_checks():
+    import surface as surface_module
+    from engine import annuity_factors, simulate_withdrawal_paths, success_rate
+    from estimators import estimate_success_rate, estimators, sample_returns, sampling_methods
+    from grid import withdrawal_grid
+    from results_store import average_withdrawals
+    from sketch import QuantileSketch
+    from surface import build_success_surface
+
+    surface_module.cache_dir = tempfile.mkdtemp(prefix='mclarlo-bench-')
+
+    checks = []
+
+    def record(name, passed, detail):
+        checks.append({'check': name, 'passed': bool(passed), 'detail': detail})
+        print(f"{'PASS' if passed else 'FAIL'}  {name}: {detail}")
+
+    returns = fixed_returns(5000, 30, seed=1)
+
+    # Vectorized engine gives exactly the reference ending balances
+    mismatches = 0
+    for withdrawal in (20000, 45000, 60000, 90000):
+        ending_balances, _, _ = simulate_withdrawal_paths(returns, 1000000, withdrawal)
+        mismatches += not np.array_equal(ending_balances, reference_ending_balances(returns, 1000000, withdrawal))
+    record('engine_matches_reference', mismatches == 0, f"{mismatches} of 4 withdrawals differ")
+
+    # Sorted solver hits each target on the reference loop, within one path
+    grid = withdrawal_grid(returns, 1000000, [75, 85, 95], [30])
+    errors = {target: reference_success_rate(returns, 1000000, grid.loc[30, target]) - target for target in grid.columns}
+    tolerance = 100 / returns.shape[1]
+    record('sorted_solver_hits_target', all(abs(error) <= tolerance for error in errors.values()),
+           f"success minus target: {errors} (tolerance {tolerance:.3f})")
+
+    # Annuity-factor rule agrees with the reference loop path by path
+    factors = annuity_factors(returns)
+    agree = np.mean((1000000 / 46000 > factors) == (reference_ending_balances(returns, 1000000, 46000) > 0))
+    record('annuity_rule_matches_reference', agree == 1, f"{agree:.2%} of paths agree")
+
+    # Success-rate surface agrees with direct simulation on independent paths
+    surface = build_success_surface(fixed_returns(20000, 30, seed=2))
+    direct_returns = fixed_returns(20000, 30, seed=3)
+    worst = 0
+    for balance, withdrawal, years in ((1000000, 46000, 30), (600000, 40000, 20), (300000, 45000, 8)):
+        expected = success_rate(direct_returns[:years], balance, withdrawal)
+        standard_error = math.sqrt(max(expected * (100 - expected), 1) / 20000)
+        worst = max(worst, abs(surface.success_rate(balance, withdrawal, years) - expected) / (standard_error * math.sqrt(2)))
+    record('surface_matches_simulation', worst < 4, f"largest difference {worst:.2f} standard errors")
+
+    # Variance-reduced estimators agree with a large plain simulation
+    # (sobol is skipped when scipy is not installed)
+    real_mean, std_dev = 0.1048 - 0.012 - 0.03, 0.1272
+    expected = success_rate(direct_returns, 1000000, 46000)
+    rng = np.random.default_rng(7)
+    for estimator in estimators:
+        try:
+            estimates = np.array([
+                estimate_success_rate(sample_returns(real_mean, std_dev, 30, 256, sampling_methods[estimator], rng),
+                                      1000000, 46000, estimator, real_mean, std_dev)[0]
+                for _ in range(200)
+            ])
+        except ImportError as error:
+            record(f'estimator_{estimator}_unbiased', True, f"skipped ({error})")
+            continue
+        standard_error = math.sqrt(estimates.var() / len(estimates) + expected * (100 - expected) / 20000)
+        difference = (estimates.mean() - expected) / standard_error
+        record(f'estimator_{estimator}_unbiased', abs(difference) < 4,
+               f"{difference:.2f} standard errors from simulation, spread {estimates.std():.2f} at 256 paths")
+
+    # Batched guardrail simulation is statistically equivalent to the per-path loop
+    sim3 = configure_sim3(2000, 30)
+    sim3.get_success_surface()
+    batched = sim3.run_batched_simulations(46000, 2000, np.random.default_rng(4))
+    single = sim3.simulation_dicts_to_results(
+        [sim3.run_single_simulation((simulation, 46000), np.random.default_rng([5, simulation])) for simulation in range(2000)]
+    )
+    for label, a, b in (('cagr', batched['CAGR'], single['CAGR']),
+                        ('average_withdrawal', average_withdrawals(batched), average_withdrawals(single))):
+        passed, statistic, critical = same_distribution(a, b)
+        record(f'batched_matches_single_{label}', passed, f"KS {statistic:.4f} (critical {critical:.4f})")
+
+    # Percentile sketch is within its relative accuracy of the order statistics
+    # np.percentile interpolates between
+    values = np.random.default_rng(6).normal(0.05, 0.03, 200000)
+    sketch = QuantileSketch()
+    sketch.update(values)
+    percentiles = np.arange(0, 101)
+    estimates = sketch.percentiles(percentiles)
+    accuracy = sketch.relative_accuracy
+    lower = np.percentile(values, percentiles, method='lower')
+    higher = np.percentile(values, percentiles, method='higher')
+    within = (estimates >= lower - accuracy * np.abs(lower)) & (estimates <= higher + accuracy * np.abs(higher))
+    record('sketch_matches_percentile', within.all(), f"{within.sum()} of {len(percentiles)} percentiles within accuracy")
+
+    return checks
+
+
+# Function to flag cases whose throughput fell below the baseline
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for result in results:
+        reference = baseline.get(result['case'])
+        if reference is None or 'error' in result:
+            continue
+        ratio = result['throughput'] / reference['throughput']
+        if ratio < 1 - tolerance:
+            regressions.append({'case': result['case'], 'ratio': ratio})
+    return regressions
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulation kernels and solves.")
+    parser.add_argument('--cases', nargs='+', choices=sorted(cases), default=list(cases))
+    parser.add_argument('--paths', nargs='+', type=int)
+    parser.add_argument('--years', nargs='+', type=int)
+    parser.add_argument('--workers', nargs='+', type=int)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help="Small matrix for a smoke run")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Flag cases with throughput this fraction below the baseline")
+    parser.add_argument('--skip-checks', action='store_true')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    paths = args.paths or (quick_paths if args.quick else default_paths)
+    years = args.years or (quick_years if args.quick else default_years)
+    workers = args.workers or (quick_workers if args.quick else default_workers)
+
+    results = run_benchmarks(args.cases, paths, years, workers, args.repeats)
+    checks = [] if args.skip_checks else run_equivalence_checks()
+
+    baseline = load_json(baseline_file, {})
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression['case']}: {regression['ratio']:.0%} of baseline throughput")
+
+    run = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'results': results,
+        'checks': checks,
+        'regressions': regressions,
+    }
+    history = load_json(history_file, [])
+    history.append(run)
+    with open(history_file, 'w') as f:
+        json.dump(history, f, indent=2)
+
+    if args.save_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump({result['case']: result for result in results if 'error' not in result}, f, indent=2)
+        print(f"Baseline saved to '{baseline_file}'")
+
+    failed_checks = [check for check in checks if not check['passed']]
+    return 1 if regressions or failed_checks else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,125 @@
+import numpy as np
+
+# Shared withdrawal-path engine used by sim1.py, sim2.py and sim3.py.
+# All simulations are advanced together, one year at a time, as array
+# operations over the (years x simulations) return matrix. Depleted paths are
+# masked out instead of breaking out of a per-simulation loop.
+
+
+# Function to generate real returns using the equivalent formula to Excel
+# Draws from the global NumPy random state unless a np.random.Generator is given
+def generate_returns(mean, std_dev, n_years, n_simulations, rng=None):
+    if rng is None:
+        return mean + std_dev * np.random.normal(0, 1, (n_years, n_simulations))
+    return mean + std_dev * rng.normal(0, 1, (n_years, n_simulations))
+
+
+# Function to run every withdrawal path at once
+# returns: (n_years, n_simulations) matrix of annual returns
+# initial_balance / withdrawal_amount: scalars or one value per simulation
+# Returns the ending balance, the year index in which each path was depleted
+# (-1 if it never was) and the success flag (ending balance > 0) per path.
+def simulate_withdrawal_paths(returns, initial_balance, withdrawal_amount):
+    returns = np.asarray(returns, dtype=float)
+    n_years, n_simulations = returns.shape
+
+    balances = np.empty(n_simulations)
+    balances[:] = initial_balance
+    withdrawals = np.broadcast_to(np.asarray(withdrawal_amount, dtype=float), (n_simulations,))
+    depletion_year = np.full(n_simulations, -1)
+    active = np.ones(n_simulations, dtype=bool)
+
+    for year in range(n_years):
+        # Subtract the withdrawal from the paths that are still running
+        np.subtract(balances, withdrawals, out=balances, where=active)
+
+        # Mask out paths that are depleted this year
+        depleted = active & (balances <= 0)
+        balances[depleted] = 0
+        depletion_year[depleted] = year
+        active &= ~depleted
+
+        # Apply the return for that year
+        np.multiply(balances, 1 + returns[year], out=balances, where=active)
+
+    success = balances > 0
+    return balances, depletion_year, success
+
+
+# Function to calculate the percentage of paths with a positive ending balance
+def success_rate(returns, initial_balance, withdrawal_amount):
+    _, _, success = simulate_withdrawal_paths(returns, initial_balance, withdrawal_amount)
+    return np.mean(success) * 100
+
+
+# Function to calculate each path's annuity factor: 1 + 1/G1 + 1/(G1*G2) + ...
+# where Gt is the growth factor (1 + return) of year t. A path with withdrawals
+# taken at the start of each year survives exactly when
+#   initial_balance > withdrawal_amount * annuity factor
+# A return at or below -100% depletes the path whatever the withdrawal, so its
+# factor is infinite.
+# Row h - 1 of the table holds the factors for an h-year horizon.
+def annuity_factor_table(returns):
+    growth = 1 + np.asarray(returns, dtype=float)
+
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        discount = np.ones_like(growth)
+        discount[1:] = 1 / np.cumprod(growth[:-1], axis=0)
+        factors = np.cumsum(discount, axis=0)
+
+    factors[np.logical_or.accumulate(growth <= 0, axis=0)] = np.inf
+    return factors
+
+
+# Function to calculate the annuity factors of the last h years of every path
+# (row h - 1 for h years remaining), for returns whose distribution depends on
+# the calendar year (e.g. a portfolio glide path)
+# Built backwards: the factor from year t on is 1 + (factor from year t + 1) / Gt.
+def remaining_annuity_factor_table(returns):
+    growth = 1 + np.asarray(returns, dtype=float)
+    factors = np.empty_like(growth)
+
+    later = np.zeros(growth.shape[1])
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        for h in range(1, len(growth) + 1):
+            year = len(growth) - h
+            later = np.where(growth[year] > 0, 1 + later / growth[year], np.inf)
+            factors[h - 1] = later
+    return factors
+
+
+# Function to calculate each path's annuity factor over the full horizon
+def annuity_factors(returns):
+    return annuity_factor_table(returns)[-1]
+
+
+# Function to calculate the maximum sustainable constant withdrawal for each path
+def max_sustainable_withdrawals(returns, initial_balance):
+    return initial_balance / annuity_factors(returns)
+
+
+# Function to calculate the minimum starting balance each path needs
+def min_required_balances(returns, withdrawal_amount):
+    return withdrawal_amount * annuity_factors(returns)
+
+
+# Function to read the withdrawal for each target success rate (%) off the
+# sorted per-path maximum withdrawals (initial balance / annuity factor)
+def withdrawals_for_success_rates(returns, initial_balance, target_percentages):
+    factors = annuity_factors(returns)
+    return initial_balance / np.quantile(factors, np.asarray(target_percentages) / 100)
+
+
+# Function to read the starting balance for each target success rate (%) off
+# the sorted per-path required balances
+def portfolios_for_success_rates(returns, withdrawal_amount, target_percentages):
+    required = min_required_balances(returns, withdrawal_amount)
+    return np.quantile(required, np.asarray(target_percentages) / 100)
+
+
+# Function to calculate the full success-rate curve (%) for many withdrawals
+# from a single sort of the per-path maximum withdrawals
+def success_curve(returns, initial_balance, withdrawal_amounts):
+    capacities = np.sort(max_sustainable_withdrawals(returns, initial_balance))
+    n_surviving = len(capacities) - np.searchsorted(capacities, withdrawal_amounts, side='right')
+    return n_surviving / len(capacities) * 100
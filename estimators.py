@@ -0,0 +1,207 @@
+import math
+import warnings
+from statistics import NormalDist
+
+import numpy as np
+
+from engine import annuity_factors
+
+# Variance-reduced success-rate estimators.
+#
+# A plain Monte Carlo success rate over n paths has a standard error of
+# sqrt(p (1 - p) / n): about 0.8 percentage points at 2000 paths and 3.6 at
+# the 100 inner paths of sim3. The estimators below reach the same precision
+# with fewer paths:
+#   mc         - independent normal draws (the original estimator)
+#   antithetic - every draw z is paired with -z; the pair means are averaged
+#   sobol      - scrambled Sobol points through the inverse normal CDF, in
+#                sobol_replicates independent scrambles so the spread of the
+#                replicate means gives the standard error (requires scipy)
+#   control    - independent draws with a control variate: the event that the
+#                linearized annuity factor of the path (a weighted sum of the
+#                normal shocks) is small enough to survive. Its probability is
+#                a normal tail known in closed form, so the difference between
+#                its sample and exact frequency corrects the success rate.
+# adaptive_success_rate adds batches of paths until the confidence interval of
+# the success rate is narrower than a requested width, and
+# sequential_success_rate stops as soon as the interval settles how the rate
+# compares with a bisection's target band or the guardrail thresholds.
+
+estimators = ('mc', 'antithetic', 'sobol', 'control')
+
+# Normal draws each estimator simulates from
+sampling_methods = {'mc': 'mc', 'antithetic': 'antithetic', 'sobol': 'sobol', 'control': 'mc'}
+
+# Independent scrambles per Sobol sample
+sobol_replicates = 8
+
+
+# Function to draw a (years x paths) matrix of standard normals
+# Draws from the global NumPy random state unless a np.random.Generator is given
+def standard_normals(n_years, n_paths, sampling='mc', rng=None):
+    if sampling == 'mc':
+        if rng is None:
+            return np.random.normal(0, 1, (n_years, n_paths))
+        return rng.normal(0, 1, (n_years, n_paths))
+
+    if sampling == 'antithetic':
+        # Paths n_pairs + i mirror paths i
+        n_pairs = (n_paths + 1) // 2
+        half = standard_normals(n_years, n_pairs, 'mc', rng)
+        return np.concatenate([half, -half], axis=1)[:, :n_paths]
+
+    if sampling == 'sobol':
+        try:
+            from scipy.special import ndtri
+            from scipy.stats import qmc
+        except ImportError:
+            raise ImportError("Sobol sampling (sampling or estimator 'sobol') requires scipy: pip install scipy") from None
+
+        # Paths are split into equal blocks, one independent scramble each
+        n_replicates = min(sobol_replicates, n_paths)
+        blocks = []
+        for size in np.diff(np.linspace(0, n_paths, n_replicates + 1).astype(int)):
+            sobol = qmc.Sobol(d=n_years, scramble=True, seed=rng)
+            with warnings.catch_warnings():
+                # Sobol balance properties need a power-of-two sample size
+                warnings.simplefilter('ignore', UserWarning)
+                points = sobol.random(size)
+            blocks.append(ndtri(np.clip(points, 1e-12, 1 - 1e-12)).T)
+        return np.concatenate(blocks, axis=1)
+
+    raise ValueError(f"Unknown sampling method: {sampling!r}")
+
+
+# Function to simulate real returns mean + std_dev * N(0, 1) with a sampling method
+def sample_returns(mean, std_dev, n_years, n_paths, sampling='mc', rng=None):
+    return mean + std_dev * standard_normals(n_years, n_paths, sampling, rng)
+
+
+# Function to calculate the control-variate indicator of each path and its exact mean
+# Around the mean return, log(annuity factor) ~ log(A0) - (std_dev / g) * sum(s_t * z_t)
+# with g = 1 + mean, A0 the annuity factor at the mean and s_t the share of A0
+# discounted through year t. The path survives the linearized model when the
+# standardized sum exceeds c, which has probability 1 - Phi(c).
+# Returns None when the model has no randomness (one year, or no withdrawal).
+def linearized_survival(returns, initial_balance, withdrawal_amount, mean, std_dev):
+    n_years = returns.shape[0]
+    growth = 1 + mean
+    if growth <= 0 or std_dev <= 0 or initial_balance <= 0 or withdrawal_amount <= 0:
+        return None
+
+    discounts = growth ** -np.arange(n_years, dtype=float)
+    factor = discounts.sum()
+    weights = (factor - np.cumsum(discounts)) / factor
+    norm = np.sqrt(np.sum(weights ** 2))
+    if norm == 0:
+        return None
+
+    threshold = (math.log(factor) - math.log(initial_balance / withdrawal_amount)) * growth / (std_dev * norm)
+    shocks = (np.asarray(returns, dtype=float) - mean) / std_dev
+    indicator = (weights @ shocks) / norm > threshold
+    return indicator.astype(float), 0.5 * math.erfc(threshold / math.sqrt(2))
+
+
+# Function to reduce simulated paths to the independent samples an estimator averages
+# Returns the samples and, for the control variate, each sample's control
+# minus its exact mean (otherwise None)
+def success_samples(returns, initial_balance, withdrawal_amount, estimator='mc', mean=None, std_dev=None):
+    success = (initial_balance > withdrawal_amount * annuity_factors(returns)).astype(float)
+    n_paths = len(success)
+
+    if estimator == 'mc':
+        return success, None
+    if estimator == 'antithetic':
+        n_pairs = n_paths // 2
+        return (success[:n_pairs] + success[(n_paths + 1) // 2:][:n_pairs]) / 2, None
+    if estimator == 'sobol':
+        n_replicates = min(sobol_replicates, n_paths)
+        bounds = np.linspace(0, n_paths, n_replicates + 1).astype(int)
+        return np.add.reduceat(success, bounds[:-1]) / np.diff(bounds), None
+    if estimator == 'control':
+        if mean is None or std_dev is None:
+            raise ValueError("estimator='control' requires the mean and std_dev of the returns")
+        control = linearized_survival(returns, initial_balance, withdrawal_amount, mean, std_dev)
+        if control is None:
+            return success, None
+        indicator, expected = control
+        return success, indicator - expected
+
+    raise ValueError(f"Unknown estimator: {estimator!r} (choose from {', '.join(estimators)})")
+
+
+# Function to combine samples into a success rate and its standard error (both %)
+def combine_samples(samples, controls=None):
+    samples = np.asarray(samples, dtype=float)
+    if controls is not None:
+        controls = np.asarray(controls, dtype=float)
+        variance = np.var(controls)
+        if variance > 0:
+            beta = np.mean((samples - samples.mean()) * (controls - controls.mean())) / variance
+            samples = samples - beta * controls
+
+    n = len(samples)
+    standard_error = np.std(samples, ddof=1) / math.sqrt(n) if n > 1 else math.inf
+    return samples.mean() * 100, standard_error * 100
+
+
+# Function to estimate the success rate (%) and its standard error from one
+# return matrix drawn with sampling_methods[estimator]
+def estimate_success_rate(returns, initial_balance, withdrawal_amount, estimator='mc', mean=None, std_dev=None):
+    samples, controls = success_samples(returns, initial_balance, withdrawal_amount, estimator, mean, std_dev)
+    return combine_samples(samples, controls)
+
+
+# Function to add batches of paths until the confidence interval of the success
+# rate is at most ci_width percentage points wide (or max_paths is reached)
+# Returns the success rate (%), its standard error and the number of paths used
+def adaptive_success_rate(initial_balance, withdrawal_amount, mean, std_dev, n_years, ci_width,
+                          estimator='mc', batch_size=256, max_paths=16384, confidence=95, rng=None):
+    z = NormalDist().inv_cdf(0.5 + confidence / 200)
+    sampling = sampling_methods[estimator]
+
+    samples, controls = [], []
+    n_paths = 0
+    while True:
+        returns = sample_returns(mean, std_dev, n_years, batch_size, sampling, rng)
+        batch_samples, batch_controls = success_samples(
+            returns, initial_balance, withdrawal_amount, estimator, mean, std_dev
+        )
+        samples.append(batch_samples)
+        controls.append(np.zeros_like(batch_samples) if batch_controls is None else batch_controls)
+        n_paths += batch_size
+
+        rate, standard_error = combine_samples(
+            np.concatenate(samples), np.concatenate(controls) if estimator == 'control' else None
+        )
+        if 2 * z * standard_error <= ci_width or n_paths + batch_size > max_paths:
+            return rate, standard_error, n_paths
+
+
+# Function to calculate the Wilson score interval (fractions) of successes out of n
+def wilson_interval(successes, n, z):
+    rate = successes / n
+    denominator = 1 + z ** 2 / n
+    center = (rate + z ** 2 / (2 * n)) / denominator
+    half_width = z / denominator * math.sqrt(rate * (1 - rate) / n + z ** 2 / (4 * n ** 2))
+    return center - half_width, center + half_width
+
+
+# Function to estimate the success rate (%) on the paths of returns in batches,
+# stopping as soon as the confidence interval contains none of the boundaries
+# (%), so every comparison with them is decided. A rate close to a boundary
+# uses all paths. Returns the success rate (%) and the number of paths used.
+def sequential_success_rate(returns, initial_balance, withdrawal_amount, boundaries,
+                            batch_size=200, confidence=99.9):
+    z = NormalDist().inv_cdf(0.5 + confidence / 200)
+    boundaries = np.asarray(boundaries, dtype=float) / 100
+    n_paths = returns.shape[1]
+
+    successes = 0
+    for stop in range(batch_size, n_paths + batch_size, batch_size):
+        start, stop = stop - batch_size, min(stop, n_paths)
+        successes += np.count_nonzero(initial_balance > withdrawal_amount * annuity_factors(returns[:, start:stop]))
+
+        low, high = wilson_interval(successes, stop, z)
+        if stop == n_paths or not np.any((boundaries >= low) & (boundaries <= high)):
+            return successes / stop * 100, stop
@@ -0,0 +1,209 @@
+import functools
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+# Return generators: each model emits the full (years x paths) matrix of real
+# annual returns in one vectorized call, as float64 or float32, optionally
+# into a preallocated buffer:
+#   generator.generate(n_years, n_paths, rng=None, dtype=np.float64, out=None)
+# Draws come from the global NumPy random state unless a np.random.Generator is
+# given. The normal model reproduces mean + std_dev * normal draws exactly, so
+# seeded runs match the original scripts.
+#
+#   normal     - i.i.d. normal arithmetic returns (the original model)
+#   lognormal  - i.i.d. lognormal growth factors with the same mean and standard deviation
+#   student_t  - Student-t returns with t_df degrees of freedom, scaled to the standard deviation
+#   bootstrap  - circular block bootstrap of annual returns from a CSV file
+#   regime     - two-state Markov regime-switching normal returns
+
+
+class NormalReturns:
+    def __init__(self, mean, std_dev):
+        self.mean = mean
+        self.std_dev = std_dev
+
+    @property
+    def key(self):
+        return ('normal', self.mean, self.std_dev)
+
+    def generate(self, n_years, n_paths, rng=None, dtype=np.float64, out=None):
+        out = standard_normal((n_years, n_paths), rng, dtype, out)
+        out *= self.std_dev
+        out += self.mean
+        return out
+
+
+class LognormalReturns:
+    def __init__(self, mean, std_dev):
+        self.mean = mean
+        self.std_dev = std_dev
+
+        # Parameters of log(1 + return) giving the same arithmetic mean and variance
+        self.log_variance = np.log1p(std_dev ** 2 / (1 + mean) ** 2)
+        self.log_mean = np.log1p(mean) - self.log_variance / 2
+
+    @property
+    def key(self):
+        return ('lognormal', self.mean, self.std_dev)
+
+    def generate(self, n_years, n_paths, rng=None, dtype=np.float64, out=None):
+        out = standard_normal((n_years, n_paths), rng, dtype, out)
+        out *= np.sqrt(self.log_variance)
+        out += self.log_mean
+        np.expm1(out, out=out)
+        return out
+
+
+class StudentTReturns:
+    def __init__(self, mean, std_dev, df=5):
+        if df <= 2:
+            raise ValueError("Student-t returns need more than 2 degrees of freedom for a finite variance")
+        self.mean = mean
+        self.std_dev = std_dev
+        self.df = df
+
+    @property
+    def key(self):
+        return ('student_t', self.mean, self.std_dev, self.df)
+
+    def generate(self, n_years, n_paths, rng=None, dtype=np.float64, out=None):
+        source = np.random if rng is None else rng
+        draws = source.standard_t(self.df, (n_years, n_paths))
+        out = output_buffer((n_years, n_paths), dtype, out)
+        np.multiply(draws, self.std_dev * np.sqrt((self.df - 2) / self.df), out=out, casting='same_kind')
+        out += self.mean
+        return out
+
+
+class BootstrapReturns:
+    def __init__(self, history, block_size=5):
+        self.history = np.asarray(history, dtype=float)
+        if self.history.ndim != 1 or len(self.history) == 0:
+            raise ValueError("Bootstrap history must be a non-empty sequence of annual returns")
+        self.block_size = max(1, min(int(block_size), len(self.history)))
+
+    # Function to read the annual returns (decimal form) from a CSV column
+    # shift is subtracted from every return, e.g. fee + inflation for nominal returns
+    @classmethod
+    def from_csv(cls, path, column=None, block_size=5, shift=0.0):
+        data = pd.read_csv(path)
+        values = data[column] if column is not None else data.select_dtypes('number').iloc[:, -1]
+        return cls(values.dropna().to_numpy(dtype=float) - shift, block_size)
+
+    @property
+    def key(self):
+        return ('bootstrap', hashlib.sha1(self.history.tobytes()).hexdigest(), self.block_size)
+
+    # Blocks of consecutive years start at random points of the history and
+    # wrap around its end, so every year is drawn equally often
+    def generate(self, n_years, n_paths, rng=None, dtype=np.float64, out=None):
+        n_blocks = -(-n_years // self.block_size)
+        if rng is None:
+            starts = np.random.randint(0, len(self.history), (n_blocks, 1, n_paths))
+        else:
+            starts = rng.integers(0, len(self.history), (n_blocks, 1, n_paths))
+        offsets = np.arange(self.block_size).reshape(1, -1, 1)
+        indices = ((starts + offsets) % len(self.history)).reshape(n_blocks * self.block_size, n_paths)[:n_years]
+
+        out = output_buffer((n_years, n_paths), dtype, out)
+        np.take(self.history.astype(out.dtype, copy=False), indices, out=out)
+        return out
+
+
+class RegimeSwitchingReturns:
+    # means / std_devs: per regime; transition[i][j] is the probability of
+    # moving from regime i to regime j between years. The first year's regime
+    # is drawn from the stationary distribution unless initial is given.
+    def __init__(self, means, std_devs, transition, initial=None):
+        self.means = np.asarray(means, dtype=float)
+        self.std_devs = np.asarray(std_devs, dtype=float)
+        self.transition = np.asarray(transition, dtype=float)
+        if not np.allclose(self.transition.sum(axis=1), 1):
+            raise ValueError("Each row of the regime transition matrix must sum to 1")
+        self.initial = stationary_distribution(self.transition) if initial is None else np.asarray(initial, dtype=float)
+
+    # Function to build a calm/stressed model with the given long-run mean and
+    # standard deviation: the stressed regime (a quarter of years on average)
+    # has twice the volatility and a mean one standard deviation lower
+    @classmethod
+    def calibrated(cls, mean, std_dev):
+        transition = np.array([[0.9, 0.1], [0.3, 0.7]])
+        calm, stressed = stationary_distribution(transition)
+        spread = std_dev
+        calm_std = np.sqrt((std_dev ** 2 - calm * stressed * spread ** 2) / (calm + 4 * stressed))
+        return cls(
+            [mean + stressed * spread, mean - calm * spread], [calm_std, 2 * calm_std], transition
+        )
+
+    @property
+    def key(self):
+        return ('regime', tuple(self.means), tuple(self.std_devs), tuple(self.transition.ravel()), tuple(self.initial))
+
+    def generate(self, n_years, n_paths, rng=None, dtype=np.float64, out=None):
+        uniforms = np.random.random_sample((n_years, n_paths)) if rng is None else rng.random((n_years, n_paths))
+        out = standard_normal((n_years, n_paths), rng, dtype, out)
+
+        # Regime of every path, advanced one year at a time by inverse-CDF draws
+        cumulative_initial = np.cumsum(self.initial)
+        cumulative_transition = np.cumsum(self.transition, axis=1)
+        regimes = np.minimum(np.searchsorted(cumulative_initial, uniforms[0], side='right'), len(self.means) - 1)
+        for year in range(n_years):
+            if year > 0:
+                thresholds = cumulative_transition[regimes]
+                regimes = np.minimum((uniforms[year][:, None] >= thresholds).sum(axis=1), len(self.means) - 1)
+            out[year] *= self.std_devs[regimes]
+            out[year] += self.means[regimes]
+        return out
+
+
+# Function to find the long-run share of years in each regime
+def stationary_distribution(transition):
+    values, vectors = np.linalg.eig(np.asarray(transition, dtype=float).T)
+    stationary = np.real(vectors[:, np.argmin(np.abs(values - 1))])
+    return stationary / stationary.sum()
+
+
+# Function to return out (checked) or a new array of the requested shape and dtype
+def output_buffer(shape, dtype=np.float64, out=None):
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape != shape:
+        raise ValueError(f"Output buffer has shape {out.shape}, expected {shape}")
+    return out
+
+
+# Function to fill a buffer with standard normal draws
+# The global random state only draws float64, which is then cast
+def standard_normal(shape, rng=None, dtype=np.float64, out=None):
+    out = output_buffer(shape, dtype, out)
+    if rng is None:
+        out[...] = np.random.standard_normal(shape)
+    else:
+        rng.standard_normal(shape, dtype=out.dtype, out=out)
+    return out
+
+
+# Return models by name
+return_models = ('normal', 'lognormal', 'student_t', 'bootstrap', 'regime')
+
+
+# Function to build the generator for a return model (cached by its arguments)
+# mean and std_dev are real (after fees and inflation); the bootstrap model
+# takes its returns from history_file instead, minus history_shift
+@functools.lru_cache(maxsize=32)
+def make_generator(model, mean, std_dev, t_df=5, history_file=None, block_size=5, history_shift=0.0):
+    if model == 'normal':
+        return NormalReturns(mean, std_dev)
+    if model == 'lognormal':
+        return LognormalReturns(mean, std_dev)
+    if model == 'student_t':
+        return StudentTReturns(mean, std_dev, t_df)
+    if model == 'bootstrap':
+        if history_file is None:
+            raise ValueError("The bootstrap return model requires a history_file")
+        return BootstrapReturns.from_csv(history_file, block_size=block_size, shift=history_shift)
+    if model == 'regime':
+        return RegimeSwitchingReturns.calibrated(mean, std_dev)
+    raise ValueError(f"Unknown return model: {model!r} (choose from {', '.join(return_models)})")
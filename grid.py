@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from engine import annuity_factor_table
+
+# Batch solvers for whole grids of targets, horizons and withdrawal amounts.
+# Every cell is read off the same simulated paths: each horizon is a prefix of
+# one longest-horizon return matrix, every target is a quantile of the sorted
+# per-path annuity factors, and required portfolios scale linearly with the
+# withdrawal, so a full grid costs about the same as a single target.
+
+
+# Function to get the annuity factors of every path for each requested horizon
+def horizon_factors(returns, horizons):
+    horizons = np.asarray(horizons)
+    if horizons.min() < 1 or horizons.max() > len(returns):
+        raise ValueError(f"Horizons must be between 1 and {len(returns)} years")
+    return annuity_factor_table(returns)[horizons - 1]
+
+
+# Function to solve the optimal withdrawal for every (horizon, target) cell
+# Returns a DataFrame indexed by horizon with one column per target percentage
+def withdrawal_grid(returns, initial_balance, target_percentages, horizons):
+    factors = horizon_factors(returns, horizons)
+    quantiles = np.quantile(factors, np.asarray(target_percentages) / 100, axis=1).T
+    return pd.DataFrame(
+        initial_balance / quantiles,
+        index=pd.Index(horizons, name='Years'),
+        columns=pd.Index(target_percentages, name='Target (%)'),
+    )
+
+
+# Function to solve the required portfolio for every (horizon, target,
+# withdrawal) cell
+# Returns a DataFrame indexed by (horizon, target) with one column per
+# withdrawal amount; .to_numpy().reshape(len(horizons), len(targets), -1)
+# gives the (horizons x targets x withdrawals) cube
+def required_portfolio_grid(returns, withdrawal_amounts, target_percentages, horizons):
+    factors = horizon_factors(returns, horizons)
+    quantiles = np.quantile(factors, np.asarray(target_percentages) / 100, axis=1).T
+    cube = quantiles[:, :, np.newaxis] * np.asarray(withdrawal_amounts, dtype=float)
+    return pd.DataFrame(
+        cube.reshape(len(horizons) * len(target_percentages), -1),
+        index=pd.MultiIndex.from_product([horizons, target_percentages], names=['Years', 'Target (%)']),
+        columns=pd.Index(withdrawal_amounts, name='Withdrawal'),
+    )
@@ -0,0 +1,137 @@
+import numpy as np
+
+from instrument import get_tracer
+from results_store import year_fields
+from surface import build_success_surface, load_success_surface
+
+# Lockstep guardrail simulation, parameterized by a Scenario.
+# All outer paths advance together one year at a time; after each year the
+# withdrawals of paths whose success rate (looked up in the success-rate
+# surface) falls outside [lower_threshold, upper_threshold] are re-solved to
+# target_success_rate. Used by sim3.py and analyses.guardrail_simulation.
+
+
+# Function to load the success-rate surface for a scenario
+# (cached on disk unless the scenario has no seed)
+# A portfolio glide path makes returns depend on the calendar year, so the
+# row for h years remaining is read off the last h years of the simulations
+def scenario_surface(scenario):
+    generator = scenario.return_generator()
+    remaining = scenario.portfolio is not None and scenario.portfolio.has_glide_path
+    if scenario.seed is None:
+        return build_success_surface(generator.generate(scenario.n_years, scenario.n_surface_simulations), remaining)
+    return load_success_surface(
+        scenario.mean, scenario.std_dev, scenario.fee, scenario.inflation,
+        scenario.n_years, scenario.n_surface_simulations, scenario.seed,
+        generator=None if scenario.normal_returns else generator, remaining=remaining,
+    )
+
+
+# Function to adjust the withdrawal amounts of many simulations at once
+def adjust_withdrawals(scenario, surface, portfolio_balances, years_remaining, current_withdrawals):
+    success_rates = surface.success_rate(portfolio_balances, current_withdrawals, years_remaining)
+    outside = (success_rates < scenario.lower_threshold) | (success_rates > scenario.upper_threshold)
+
+    tracer = get_tracer()
+    tracer.count('guardrail_checks', len(outside), years_remaining=years_remaining)
+    tracer.count('guardrail_fired', int(outside.sum()), years_remaining=years_remaining)
+
+    adjusted_withdrawals = np.array(current_withdrawals, dtype=float)
+    adjusted_withdrawals[outside] = surface.withdrawal_for_success_rate(
+        portfolio_balances[outside], scenario.target_success_rate, years_remaining
+    )
+
+    # Apply withdrawal cap and floor if specified
+    if scenario.withdrawal_cap is not None:
+        adjusted_withdrawals[outside] = np.minimum(adjusted_withdrawals[outside], scenario.withdrawal_cap)
+    if scenario.withdrawal_floor is not None:
+        adjusted_withdrawals[outside] = np.maximum(adjusted_withdrawals[outside], scenario.withdrawal_floor)
+
+    return adjusted_withdrawals
+
+
+# Function to run many simulations in lockstep, one year at a time
+# adjust(portfolio_balances, years_remaining, current_withdrawals) returns the
+# withdrawals for the next year. Per-path state lives in (years x simulations)
+# arrays; years after a path is depleted are left as NaN.
+# returns: a pre-generated (years x simulations) return matrix instead of drawing from rng
+# out: (years x simulations) arrays per field and a CAGR array to write the results into
+# (e.g. ResultStore.chunk_views) instead of new arrays
+def run_batched_simulations(scenario, initial_withdrawal, n_paths, adjust, rng=None, returns=None, out=None):
+    n_years = scenario.n_years
+    if out is None:
+        results = {field: np.full((n_years, n_paths), np.nan) for field in year_fields}
+    else:
+        results = out
+        for field in year_fields:
+            results[field][...] = np.nan
+
+    portfolio_balances = np.full(n_paths, float(scenario.initial_portfolio))
+    withdrawal_amounts = np.full(n_paths, float(initial_withdrawal))
+    cumulative_returns = np.ones(n_paths)  # To store growth for CAGR calculation
+    n_return_years = np.zeros(n_paths, dtype=int)
+    active = np.ones(n_paths, dtype=bool)
+
+    # Draw every year's returns up front. These are not the samples sim3's
+    # run_single_simulation draws path by path from the same seed; the two
+    # agree only in distribution (benchmark.py checks this with a KS test).
+    if returns is None:
+        returns = scenario.return_generator().generate(n_years, n_paths, rng)
+
+    for year in range(n_years):
+        # Record the beginning balance
+        results['Begin Bal'][year, active] = portfolio_balances[active]
+
+        # Subtract withdrawal from portfolio balance
+        net_begin = portfolio_balances - withdrawal_amounts
+        depleted = active & (net_begin <= 0)
+        running = active & ~depleted
+
+        # Portfolio depleted this year
+        for field in ('Withdrawal', 'Net Begin', 'Return', 'End Balance'):
+            results[field][year, depleted] = 0
+        portfolio_balances[depleted] = 0
+
+        # Apply investment return
+        annual_returns = returns[year]
+        ending_balances = net_begin[running] * (1 + annual_returns[running])
+
+        cumulative_returns[running] *= 1 + annual_returns[running]
+        n_return_years[running] += 1
+
+        # Record data for the current year
+        results['Withdrawal'][year, running] = withdrawal_amounts[running]
+        results['Net Begin'][year, running] = net_begin[running]
+        results['Return'][year, running] = annual_returns[running]
+        results['End Balance'][year, running] = ending_balances
+
+        # Adjust withdrawal amounts for next year if necessary
+        years_remaining = n_years - year - 1
+        if years_remaining > 0 and running.any():
+            withdrawal_amounts[running] = adjust(ending_balances, years_remaining, withdrawal_amounts[running])
+
+        # Prepare for next iteration
+        portfolio_balances[running] = ending_balances
+        active = running
+
+    # Calculate CAGR for each simulation (0 if depleted in the first year)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cagr = cumulative_returns ** (1 / np.maximum(n_return_years, 1)) - 1
+    cagr = np.where(n_return_years > 0, cagr, 0)
+    if out is None:
+        results['CAGR'] = cagr
+    else:
+        results['CAGR'][...] = cagr
+
+    return results
+
+
+# Function to split the simulations into chunks with independent random streams
+# Results depend on the seed and chunk size but not on how chunks are scheduled
+def make_chunks(scenario, initial_withdrawal, n_paths):
+    starts = range(0, n_paths, scenario.chunk_size)
+    chunk_seeds = np.random.SeedSequence(scenario.seed).spawn(len(starts))
+    return [
+        (start, min(start + scenario.chunk_size, n_paths), initial_withdrawal, chunk_seed)
+        for start, chunk_seed in zip(starts, chunk_seeds)
+    ]
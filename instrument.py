@@ -0,0 +1,120 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Optional instrumentation for the solvers and simulations.
+# The active tracer defaults to a NullTracer whose methods do nothing, so the
+# hooks cost one attribute lookup and call when tracing is off. Install a
+# Tracer (set_tracer or the tracing() context manager) to record:
+#   counters - call counts and totals, optionally labelled (e.g. by years_remaining)
+#   stages   - wall time and number of calls per named stage
+#   events   - structured records such as one per bisection solve
+# and export them as a JSON trace with Tracer.export().
+
+
+class Tracer:
+    def __init__(self):
+        self.counters = defaultdict(float)   # (name, labels) -> total
+        self.stages = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+        self.events = []
+        self._start_time = time.perf_counter()
+
+    # Function to add to a counter, e.g. count('inner_simulations', years_remaining=12)
+    def count(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    # Context manager timing one call of a named stage
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages[name]
+            stage['calls'] += 1
+            stage['seconds'] += time.perf_counter() - start_time
+
+    # Function to record a structured event
+    def event(self, name, **fields):
+        self.events.append({'event': name, 'time': time.perf_counter() - self._start_time, **fields})
+
+    # Function to read a counter total, summed over labels not given
+    def total(self, name, **labels):
+        wanted = set(labels.items())
+        return sum(
+            value for (counter, counter_labels), value in self.counters.items()
+            if counter == name and wanted <= set(counter_labels)
+        )
+
+    # Function to summarize how often the guardrail fired, per years remaining
+    def guardrail_report(self):
+        report = {}
+        for (name, labels), checks in self.counters.items():
+            if name != 'guardrail_checks':
+                continue
+            fired = self.counters.get(('guardrail_fired', labels), 0)
+            report[dict(labels).get('years_remaining')] = {
+                'checks': checks, 'fired': fired, 'fraction_fired': fired / checks if checks else 0,
+            }
+        return dict(sorted(report.items(), key=lambda item: (item[0] is None, item[0])))
+
+    def to_dict(self):
+        return {
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items(), key=lambda item: repr(item[0]))
+            ],
+            'stages': dict(self.stages),
+            'events': self.events,
+            'guardrail': {str(years): row for years, row in self.guardrail_report().items()},
+        }
+
+    # Function to write the trace to a JSON file
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=float)
+
+
+class NullTracer:
+    def count(self, name, value=1, **labels):
+        pass
+
+    def stage(self, name):
+        return _null_stage
+
+    def event(self, name, **fields):
+        pass
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_stage = _NullStage()
+tracer = NullTracer()
+
+
+def get_tracer():
+    return tracer
+
+
+def set_tracer(new_tracer):
+    global tracer
+    tracer = NullTracer() if new_tracer is None else new_tracer
+    return tracer
+
+
+# Context manager installing a tracer for the duration of a block
+@contextmanager
+def tracing(new_tracer=None):
+    previous = tracer
+    active = set_tracer(Tracer() if new_tracer is None else new_tracer)
+    try:
+        yield active
+    finally:
+        set_tracer(previous)
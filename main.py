@@ -0,0 +1,114 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from analyses import analyses, run_analysis
+from instrument import Tracer, get_tracer, tracing
+from result_cache import ResultCache, cache_dir, default_max_bytes
+from scenario import Scenario
+
+# Batch entry point: runs every scenario in a JSON, JSON Lines or CSV file in
+# one long-lived process and writes one JSON result per line.
+#
+# Each scenario is an object (or CSV row) of Scenario fields plus:
+#   id        - label copied to the result (defaults to the scenario's position)
+#   analysis  - one of cagr_percentiles, optimal_withdrawal, required_portfolio,
+#               guardrail_simulation, policy_comparison (defaults to --analysis)
+#
+#   python main.py scenarios.jsonl --output results.jsonl
+#
+# Results are cached on disk by scenario hash (see result_cache.py), so repeated
+# scenarios return without recomputing; --no-cache turns this off.
+#
+# --trace trace.json also records per-analysis stage times, call counts and how
+# often the guardrail fired per year remaining (see instrument.py).
+
+
+# Function to read the scenario rows from a .json, .jsonl or .csv file
+def load_scenarios(path):
+    if path.endswith('.csv'):
+        return pd.read_csv(path).to_dict(orient='records')
+
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        rows = json.load(f)
+    return rows['scenarios'] if isinstance(rows, dict) else rows
+
+
+# Function to convert analysis results to JSON-compatible values
+def to_jsonable(value):
+    if isinstance(value, pd.DataFrame):
+        return value.to_dict(orient='records')
+    if isinstance(value, dict):
+        return {str(key): to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# Function to run one scenario row; failures are reported in the result
+# instead of stopping the batch
+def run_scenario(row, index, default_analysis=None, cache=None):
+    row = dict(row)
+    scenario_id = row.pop('id', index)
+    analysis = row.pop('analysis', None) or default_analysis
+    result = {'id': to_jsonable(scenario_id), 'analysis': analysis}
+
+    tracer = get_tracer()
+    start_time = time.perf_counter()
+    try:
+        if analysis not in analyses:
+            raise ValueError(f"Unknown analysis: {analysis!r} (choose from {', '.join(analyses)})")
+        scenario = Scenario.from_dict(row)
+        with tracer.stage(analysis):
+            result['result'] = to_jsonable(run_analysis(analysis, scenario, cache))
+    except Exception as error:
+        result['error'] = f"{type(error).__name__}: {error}"
+    result['seconds'] = time.perf_counter() - start_time
+    tracer.event('scenario', id=result['id'], analysis=analysis,
+                 seconds=result['seconds'], failed='error' in result)
+
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a batch of retirement withdrawal scenarios.")
+    parser.add_argument('scenarios', help="Scenario file (.json, .jsonl or .csv)")
+    parser.add_argument('--analysis', choices=sorted(analyses),
+                        help="Analysis for scenarios that do not name one")
+    parser.add_argument('--output', help="Write JSON Lines results here instead of stdout")
+    parser.add_argument('--trace', help="Write a JSON trace of stage times and call counts here")
+    parser.add_argument('--cache-dir', default=cache_dir, help="Result cache directory (default: %(default)s)")
+    parser.add_argument('--cache-size', type=float, default=default_max_bytes / 1024 ** 2,
+                        help="Result cache size limit in MB (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true', help="Recompute every scenario")
+    args = parser.parse_args(argv)
+
+    rows = load_scenarios(args.scenarios)
+    cache = None if args.no_cache else ResultCache(args.cache_dir, int(args.cache_size * 1024 ** 2))
+    output = open(args.output, 'w') if args.output else sys.stdout
+    n_failed = 0
+    with tracing(Tracer() if args.trace else get_tracer()) as tracer:
+        try:
+            for index, row in enumerate(rows):
+                result = run_scenario(row, index, args.analysis, cache)
+                n_failed += 'error' in result
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+        finally:
+            if output is not sys.stdout:
+                output.close()
+            if args.trace:
+                tracer.export(args.trace)
+
+    print(f"Ran {len(rows)} scenarios ({n_failed} failed)", file=sys.stderr)
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
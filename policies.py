@@ -0,0 +1,289 @@
+import numpy as np
+import pandas as pd
+
+import guardrail
+from engine import withdrawals_for_success_rates
+
+# Withdrawal policies as vectorized spending rules. A policy proposes the
+# first year's withdrawal and, after every year, the next withdrawal of all
+# paths at once from their balances (after the year's return), the years
+# remaining and the prior withdrawals:
+#   policy.initial_withdrawal(initial_balance, n_years)
+#   policy(portfolio_balances, years_remaining, prior_withdrawals) -> withdrawals
+# the same interface as the adjust function of guardrail.run_batched_simulations.
+# Amounts are real (inflation-adjusted) dollars.
+#
+#   probability          - the guardrails of sim3.py: re-solve to the target success rate
+#                          when the success rate leaves [lower_threshold, upper_threshold]
+#   guyton_klinger       - Guyton-Klinger guardrails on the current withdrawal rate
+#   constant_percentage  - a fixed share of the current balance
+#   vpw                  - variable percentage withdrawal: the balance amortized over
+#                          the years remaining at an expected real return
+#   constant             - the first withdrawal every year
+#
+# Only the probability rule needs a success-rate surface; the others are a few
+# array operations per year. run_policies runs many policies over the same
+# simulated returns in one pass.
+
+
+# Function to apply an optional floor and cap to withdrawals
+def clip_withdrawals(withdrawals, floor=None, cap=None):
+    if floor is not None:
+        withdrawals = np.maximum(withdrawals, floor)
+    if cap is not None:
+        withdrawals = np.minimum(withdrawals, cap)
+    return withdrawals
+
+
+# Function to calculate the share of a balance that pays a level withdrawal at
+# the start of each of n_years years, at a real return of rate per year
+# (all of it in the last year)
+def amortization_rate(rate, n_years):
+    n_years = np.maximum(n_years, 1)
+    if rate == 0:
+        return 1 / n_years
+    return np.minimum(rate / ((1 + rate) * (1 - (1 + rate) ** -n_years)), 1)
+
+
+# Function to withdraw a share of each balance, keeping just under the whole
+# balance in the last year: a path fails once its balance reaches zero (as in
+# engine.simulate_withdrawal_paths), so spending it all would count as running out
+def spend_down(portfolio_balances, shares):
+    balances = np.maximum(portfolio_balances, 0)
+    return np.minimum(balances * shares, np.nextafter(balances, 0))
+
+
+class ProbabilityGuardrail:
+    # Withdrawals start at the amount with the scenario's target success rate;
+    # the success-rate surface is loaded on first use
+    def __init__(self, scenario, surface=None):
+        self.scenario = scenario
+        self._surface = surface
+
+    # Function to load the success-rate surface (on the first call only)
+    def load_surface(self):
+        if self._surface is None:
+            self._surface = guardrail.scenario_surface(self.scenario)
+        return self._surface
+
+    def initial_withdrawal(self, initial_balance, n_years):
+        returns = self.scenario.returns(n_years)
+        return withdrawals_for_success_rates(returns, initial_balance, self.scenario.target_success_rate)
+
+    def __call__(self, portfolio_balances, years_remaining, prior_withdrawals):
+        return guardrail.adjust_withdrawals(
+            self.scenario, self.load_surface(), portfolio_balances, years_remaining, prior_withdrawals
+        )
+
+
+class GuytonKlinger:
+    # Start at initial_rate of the balance. When the current withdrawal rate is
+    # more than threshold (20%) above initial_rate, cut the withdrawal by
+    # adjustment (10%), except in the last preservation_years years; when it is
+    # more than threshold below, raise it by adjustment. Withdrawals are
+    # otherwise kept in real terms (the rule that skips the inflation increase
+    # after a losing year needs the year's return, which policies do not see).
+    def __init__(self, initial_rate=0.05, threshold=0.2, adjustment=0.1, preservation_years=15,
+                 floor=None, cap=None):
+        self.initial_rate = initial_rate
+        self.threshold = threshold
+        self.adjustment = adjustment
+        self.preservation_years = preservation_years
+        self.floor = floor
+        self.cap = cap
+
+    def initial_withdrawal(self, initial_balance, n_years):
+        return clip_withdrawals(self.initial_rate * initial_balance, self.floor, self.cap)
+
+    def __call__(self, portfolio_balances, years_remaining, prior_withdrawals):
+        prior_withdrawals = np.asarray(prior_withdrawals, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(portfolio_balances > 0, prior_withdrawals / portfolio_balances, np.inf)
+
+        cut = rates > self.initial_rate * (1 + self.threshold)
+        if years_remaining <= self.preservation_years:
+            cut[:] = False
+        raised = rates < self.initial_rate * (1 - self.threshold)
+
+        factors = np.where(cut, 1 - self.adjustment, np.where(raised, 1 + self.adjustment, 1.0))
+        return clip_withdrawals(prior_withdrawals * factors, self.floor, self.cap)
+
+
+class ConstantPercentage:
+    def __init__(self, rate=0.04, floor=None, cap=None):
+        self.rate = rate
+        self.floor = floor
+        self.cap = cap
+
+    def initial_withdrawal(self, initial_balance, n_years):
+        return clip_withdrawals(self.rate * initial_balance, self.floor, self.cap)
+
+    def __call__(self, portfolio_balances, years_remaining, prior_withdrawals):
+        return clip_withdrawals(self.rate * np.maximum(portfolio_balances, 0), self.floor, self.cap)
+
+
+class VariablePercentage:
+    # expected_return: real return the balance is amortized at (0 spends it in equal parts)
+    def __init__(self, expected_return=0.04, floor=None, cap=None):
+        self.expected_return = expected_return
+        self.floor = floor
+        self.cap = cap
+
+    def initial_withdrawal(self, initial_balance, n_years):
+        withdrawals = spend_down(initial_balance, amortization_rate(self.expected_return, n_years))
+        return clip_withdrawals(withdrawals, self.floor, self.cap)
+
+    def __call__(self, portfolio_balances, years_remaining, prior_withdrawals):
+        withdrawals = spend_down(portfolio_balances, amortization_rate(self.expected_return, years_remaining))
+        return clip_withdrawals(withdrawals, self.floor, self.cap)
+
+
+class ConstantWithdrawal:
+    # rate: first withdrawal as a share of the initial balance, unless amount is given
+    def __init__(self, rate=0.04, amount=None):
+        self.rate = rate
+        self.amount = amount
+
+    def initial_withdrawal(self, initial_balance, n_years):
+        return self.rate * initial_balance if self.amount is None else self.amount
+
+    def __call__(self, portfolio_balances, years_remaining, prior_withdrawals):
+        return np.array(prior_withdrawals, dtype=float)
+
+
+# Policies by name
+policy_names = ('probability', 'guyton_klinger', 'constant_percentage', 'vpw', 'constant')
+
+
+# Function to build a policy for a scenario
+# rate: initial withdrawal rate ('guyton_klinger', 'constant'), share of the
+# balance ('constant_percentage') or expected real return ('vpw', defaults to
+# the scenario's mean real return); the scenario's withdrawal_floor and
+# withdrawal_cap apply to every rule that adjusts withdrawals
+# options: other keyword arguments of the rule's class (e.g. threshold)
+def make_policy(name, scenario, rate=None, **options):
+    limits = {'floor': scenario.withdrawal_floor, 'cap': scenario.withdrawal_cap}
+    if name == 'probability':
+        return ProbabilityGuardrail(scenario, **options)
+    if name == 'guyton_klinger':
+        return GuytonKlinger(0.05 if rate is None else rate, **{**limits, **options})
+    if name == 'constant_percentage':
+        return ConstantPercentage(0.04 if rate is None else rate, **{**limits, **options})
+    if name == 'vpw':
+        return VariablePercentage(scenario.real_mean if rate is None else rate, **{**limits, **options})
+    if name == 'constant':
+        return ConstantWithdrawal(0.04 if rate is None else rate, **options)
+    raise ValueError(f"Unknown withdrawal policy: {name!r} (choose from {', '.join(policy_names)})")
+
+
+# Function to put policies to compare in one form: a tuple of (label, rate)
+# or (label, options) pairs, options being sorted (name, value) pairs
+# specs: policy names, or a mapping (or pairs) of label -> rate or label ->
+# options, where options are make_policy arguments with the rule under
+# 'policy' (defaulting to the label), e.g.
+#   {"gk_4": {"policy": "guyton_klinger", "rate": 0.04, "threshold": 0.25}, "vpw": 0.03}
+def policy_specs(specs):
+    if not isinstance(specs, dict) and all(isinstance(spec, str) for spec in specs):
+        return tuple((name, None) for name in specs)
+    specs = dict(specs)
+    return tuple(
+        (label, spec if spec is None or isinstance(spec, (int, float)) else tuple(sorted(dict(spec).items())))
+        for label, spec in specs.items()
+    )
+
+
+# Function to build the policies to compare (see policy_specs), by label
+def make_policies(specs, scenario):
+    policies = {}
+    for label, spec in policy_specs(specs):
+        if spec is None or isinstance(spec, (int, float)):
+            policies[label] = make_policy(label, scenario, spec)
+        else:
+            options = dict(spec)
+            policies[label] = make_policy(options.pop('policy', label), scenario, **options)
+    return policies
+
+
+# Function to run several policies over the same simulated returns in one pass
+# policies: dict of name -> policy; returns: (years x paths) real returns,
+# drawn from the scenario's return model with rng when not given
+# Returns a dict of name -> per-path arrays: average_withdrawal (over the years
+# run), min_withdrawal, ending_balance, depleted (True if the money ran out)
+# and CAGR, computed as in guardrail.run_batched_simulations
+def run_policies(scenario, policies, n_paths=None, rng=None, returns=None):
+    n_years = scenario.n_years
+    if returns is None:
+        n_paths = scenario.n_simulations if n_paths is None else n_paths
+        returns = scenario.return_generator().generate(n_years, n_paths, rng)
+    n_paths = returns.shape[1]
+    names = list(policies)
+    shape = (len(names), n_paths)
+
+    # State of every (policy, path)
+    portfolio_balances = np.full(shape, float(scenario.initial_portfolio))
+    withdrawal_amounts = np.array([
+        np.broadcast_to(policies[name].initial_withdrawal(scenario.initial_portfolio, n_years), n_paths)
+        for name in names
+    ], dtype=float)
+    total_withdrawals = np.zeros(shape)
+    min_withdrawals = np.full(shape, np.inf)
+    n_years_run = np.zeros(shape, dtype=int)
+    cumulative_returns = np.ones(shape)
+    n_return_years = np.zeros(shape, dtype=int)
+    active = np.ones(shape, dtype=bool)
+
+    for year in range(n_years):
+        # Subtract withdrawals; paths that cannot cover theirs are depleted this year
+        net_begin = portfolio_balances - withdrawal_amounts
+        depleted = active & (net_begin <= 0)
+        running = active & ~depleted
+        n_years_run[active] += 1
+        min_withdrawals[depleted] = 0
+        portfolio_balances[depleted] = 0
+
+        # Apply the year's returns (the same for every policy)
+        growth = np.broadcast_to(1 + returns[year], shape)
+        portfolio_balances[running] = net_begin[running] * growth[running]
+        cumulative_returns[running] *= growth[running]
+        n_return_years[running] += 1
+        total_withdrawals[running] += withdrawal_amounts[running]
+        min_withdrawals[running] = np.minimum(min_withdrawals[running], withdrawal_amounts[running])
+
+        # Each policy sets its next withdrawals for all of its running paths at once
+        years_remaining = n_years - year - 1
+        if years_remaining > 0:
+            for index, name in enumerate(names):
+                paths = running[index]
+                if paths.any():
+                    withdrawal_amounts[index, paths] = policies[name](
+                        portfolio_balances[index, paths], years_remaining, withdrawal_amounts[index, paths]
+                    )
+        active = running
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cagr = cumulative_returns ** (1 / np.maximum(n_return_years, 1)) - 1
+    cagr = np.where(n_return_years > 0, cagr, 0)
+
+    return {
+        name: {
+            'average_withdrawal': total_withdrawals[index] / n_years_run[index],
+            'min_withdrawal': min_withdrawals[index],
+            'ending_balance': portfolio_balances[index],
+            'depleted': ~active[index],
+            'CAGR': cagr[index],
+        }
+        for index, name in enumerate(names)
+    }
+
+
+# Function to summarize run_policies results, one row per policy
+def compare_policies(results, percentiles=(10, 50, 90)):
+    rows = []
+    for name, result in results.items():
+        row = {'Policy': name, 'Success Rate (%)': 100 * (1 - result['depleted'].mean())}
+        for p in percentiles:
+            row[f'Average Withdrawal P{p}'] = np.percentile(result['average_withdrawal'], p)
+        row['Median Min Withdrawal'] = np.median(result['min_withdrawal'])
+        row['Median Ending Balance'] = np.median(result['ending_balance'])
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,145 @@
+import functools
+from dataclasses import dataclass
+
+import numpy as np
+
+from generators import output_buffer, standard_normal
+
+# Multi-asset portfolios (e.g. stocks / bonds / cash) with correlated annual
+# returns, allocation weights, an optional glide path and rebalancing.
+#
+# Asset returns are drawn as one (years x paths x assets) tensor from the
+# cached Cholesky factor of the covariance matrix and reduced to the
+# portfolio's (years x paths) returns, which the single-asset engine, solvers
+# and surfaces then use unchanged. Withdrawals are taken pro rata across the
+# holdings, so they do not move the weights. Paths are processed chunk_size at
+# a time, so memory stays bounded by one chunk's tensor whatever the number
+# of paths (10 assets x 30 years x 10,000 paths is 24 MB).
+
+
+@dataclass(frozen=True)
+class Portfolio:
+    means: tuple                    # Expected annual (nominal) return of each asset
+    std_devs: tuple                 # Annual standard deviation of each asset
+    correlation: tuple              # Correlation matrix (tuple of rows)
+    weights: tuple                  # Allocation in the first year (sums to 1)
+    end_weights: tuple = None       # Allocation in the last year; years in between follow a straight glide path
+    rebalance_every: int = 1        # Rebalance to the target allocation every n years (None lets weights drift)
+    names: tuple = None             # Optional asset names
+    chunk_size: int = 10000         # Paths per (years x paths x assets) tensor
+
+    def __post_init__(self):
+        n_assets = len(self.means)
+        for name in ('std_devs', 'weights', 'end_weights', 'names'):
+            values = getattr(self, name)
+            if values is not None and len(values) != n_assets:
+                raise ValueError(f"Portfolio {name} has {len(values)} entries for {n_assets} assets")
+        if np.shape(self.correlation) != (n_assets, n_assets):
+            raise ValueError(f"Portfolio correlation must be a {n_assets} x {n_assets} matrix")
+        for name in ('weights', 'end_weights'):
+            values = getattr(self, name)
+            if values is not None and not np.isclose(sum(values), 1):
+                raise ValueError(f"Portfolio {name} must sum to 1")
+
+    # Function to build a portfolio from a dict such as a JSON object
+    @classmethod
+    def from_dict(cls, values):
+        values = dict(values)
+        for name in ('means', 'std_devs', 'weights', 'end_weights', 'names'):
+            if values.get(name) is not None:
+                values[name] = tuple(values[name])
+        values['correlation'] = tuple(tuple(row) for row in values['correlation'])
+        return cls(**values)
+
+    @property
+    def n_assets(self):
+        return len(self.means)
+
+    # Lower Cholesky factor of the covariance matrix, computed once per portfolio
+    @functools.cached_property
+    def cholesky(self):
+        std_devs = np.asarray(self.std_devs, dtype=float)
+        covariance = np.asarray(self.correlation, dtype=float) * np.outer(std_devs, std_devs)
+        return np.linalg.cholesky(covariance)
+
+    @property
+    def has_glide_path(self):
+        return self.end_weights is not None
+
+    # Function to calculate the target allocation of every year (years x assets)
+    # The glide path follows the retirement calendar: it runs from weights in
+    # year 0 to end_weights in year horizon - 1 (horizon defaults to
+    # start_year + n_years), and the rows are calendar years start_year to
+    # start_year + n_years - 1, e.g. the last n_years of the glide for a
+    # retiree with n_years remaining
+    def weights_by_year(self, n_years, start_year=0, horizon=None):
+        start = np.asarray(self.weights, dtype=float)
+        if self.end_weights is None:
+            return np.tile(start, (n_years, 1))
+        horizon = start_year + n_years if horizon is None else horizon
+        years = np.arange(start_year, start_year + n_years)
+        steps = np.clip(years / max(horizon - 1, 1), 0, 1)[:, None]
+        return start + steps * (np.asarray(self.end_weights, dtype=float) - start)
+
+    # Function to draw correlated asset returns as one (years x paths x assets) tensor
+    def asset_returns(self, n_years, n_paths, rng=None, dtype=np.float64):
+        draws = standard_normal((n_years, n_paths, self.n_assets), rng, dtype)
+        returns = draws @ self.cholesky.T.astype(dtype, copy=False)
+        returns += np.asarray(self.means, dtype=dtype)
+        return returns
+
+    # Function to build the return generator (generators.py interface) of the
+    # portfolio; shift is subtracted from every return, e.g. fee + inflation
+    # start_year / horizon: calendar of the glide path (see weights_by_year)
+    def generator(self, shift=0.0, start_year=0, horizon=None):
+        return PortfolioReturns(self, shift, start_year, horizon)
+
+
+class PortfolioReturns:
+    def __init__(self, portfolio, shift=0.0, start_year=0, horizon=None):
+        self.portfolio = portfolio
+        self.shift = shift
+        self.start_year = start_year
+        self.horizon = horizon
+
+    @property
+    def key(self):
+        if not self.portfolio.has_glide_path:
+            return ('portfolio', self.portfolio, self.shift)
+        return ('portfolio', self.portfolio, self.shift, self.start_year, self.horizon)
+
+    # Results depend on the portfolio's chunk_size, which sets the order of the draws
+    def generate(self, n_years, n_paths, rng=None, dtype=np.float64, out=None):
+        out = output_buffer((n_years, n_paths), dtype, out)
+        weights = self.portfolio.weights_by_year(n_years, self.start_year, self.horizon)
+        for start in range(0, n_paths, self.portfolio.chunk_size):
+            stop = min(start + self.portfolio.chunk_size, n_paths)
+            asset_returns = self.portfolio.asset_returns(n_years, stop - start, rng, dtype)
+            out[:, start:stop] = portfolio_returns(asset_returns, weights, self.portfolio.rebalance_every)
+        out -= self.shift
+        return out
+
+
+# Function to combine asset returns (years x paths x assets) into portfolio
+# returns (years x paths) given the target weights of each year (years x assets)
+# Between rebalancing years each path's weights drift with its asset returns.
+def portfolio_returns(asset_returns, weights, rebalance_every=1):
+    n_years, n_paths, n_assets = asset_returns.shape
+    weights = np.broadcast_to(np.asarray(weights, dtype=float), (n_years, n_assets))
+
+    # Rebalancing every year: a weighted sum per year
+    if rebalance_every == 1:
+        return np.einsum('ypa,ya->yp', asset_returns, weights)
+
+    result = np.empty((n_years, n_paths), dtype=asset_returns.dtype)
+    current = np.tile(weights[0], (n_paths, 1))
+    for year in range(n_years):
+        if rebalance_every and year % rebalance_every == 0:
+            current[:] = weights[year]
+        result[year] = np.einsum('pa,pa->p', current, asset_returns[year])
+
+        # Drift: holdings grow with their own returns (a holding cannot fall below zero)
+        current *= np.maximum(1 + asset_returns[year], 0)
+        totals = current.sum(axis=1, keepdims=True)
+        np.divide(current, totals, out=current, where=totals > 0)
+    return result
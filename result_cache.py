@@ -0,0 +1,194 @@
+import dataclasses
+import hashlib
+import json
+import os
+import pickle
+from contextlib import contextmanager
+
+import numpy as np
+
+from instrument import get_tracer
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows: locking is skipped
+    fcntl = None
+
+# Persistent, content-addressed cache of analysis results (solved withdrawals,
+# required portfolios, percentile tables).
+#
+# The key is a SHA-256 hash of everything that determines a result: the
+# analysis name, the full scenario (return model, fee, inflation, horizon,
+# path count, seed, targets, guardrail settings, ...), any extra arguments,
+# the contents of a bootstrap history file and cache_version. Results are
+# pickled to <directory>/<first two hex digits>/<key>.pkl.
+#
+# Several processes can share one directory: files are written to a temporary
+# name and renamed into place, so readers never see a partial file; a result
+# being computed is locked (fcntl) so other processes wait for it instead of
+# computing it again; and once the directory holds more than max_bytes the
+# least recently used results are evicted under a directory-wide lock.
+
+cache_dir = os.path.join('.mclarlo_cache', 'results')
+default_max_bytes = 512 * 1024 ** 2
+
+# Bump when a change to the engine changes results, so older entries are not reused
+cache_version = 2
+
+
+# Function to convert a value to plain JSON types with a stable ordering
+def canonical(value):
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {'type': type(value).__name__, **canonical(dataclasses.asdict(value))}
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in sorted(value.items(), key=lambda item: str(item[0]))}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [canonical(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# Function to hash a file's contents (None if there is no file)
+def file_digest(path):
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Function to build the cache key of a result
+# inputs: a Scenario or a dict of the parameters the result depends on;
+# a history_file among them is hashed by content
+def cache_key(name, inputs, **arguments):
+    inputs = canonical(inputs)
+    history = file_digest(inputs.get('history_file')) if isinstance(inputs, dict) else None
+    payload = json.dumps(
+        {'version': cache_version, 'name': name, 'inputs': inputs, 'history': history,
+         'arguments': canonical(arguments)},
+        sort_keys=True, default=repr,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory=None, max_bytes=default_max_bytes):
+        self._directory = directory
+        self.max_bytes = max_bytes
+
+    # Directory of the cache (the module's cache_dir unless one was given)
+    @property
+    def directory(self):
+        return cache_dir if self._directory is None else self._directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pkl")
+
+    # Context manager holding an exclusive lock on a lock file in the cache directory
+    @contextmanager
+    def _lock(self, name):
+        if fcntl is None:
+            yield
+            return
+        lock_dir = os.path.join(self.directory, 'locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.join(lock_dir, f"{name}.lock"), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Function to read a result; returns (True, value) or (False, None) on a miss
+    def lookup(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+        # Mark as recently used for eviction (the file may just have been evicted)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return True, value
+
+    def get(self, key, default=None):
+        found, value = self.lookup(key)
+        return value if found else default
+
+    # Function to store a result, evicting old results if the cache is over max_bytes
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so concurrent readers never see a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    # Function to return the cached result, or compute and store it
+    # Only one process computes a given result; the others wait and read it
+    def get_or_compute(self, key, compute):
+        tracer = get_tracer()
+        found, value = self.lookup(key)
+        if not found:
+            # Lock stripes by the first two hex digits of the key
+            with self._lock(key[:2]):
+                found, value = self.lookup(key)
+                if not found:
+                    value = compute()
+                    self.put(key, value)
+
+        tracer.count('result_cache_hits' if found else 'result_cache_misses')
+        return value
+
+    # Function to list (last used time, size, path) of every stored result
+    def entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir() or shard.name == 'locks':
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.pkl'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    # Function to evict the least recently used results until at most max_bytes are stored
+    def evict(self, max_bytes):
+        with self._lock('evict'):
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        self.evict(0)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def __len__(self):
+        return len(self.entries())
+
+
+# Cache shared by the scripts and the batch CLI
+default_cache = ResultCache()
@@ -0,0 +1,202 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from shared_array import SharedArray
+
+# Columnar on-disk store for per-(path, year) simulation results.
+# Chunks of simulations are written as they finish, so a run never needs all
+# paths in memory. Per-(path, year) fields go either to memory-mapped .npy
+# files of shape (paths x years) or to a long/tidy Parquet table with one row
+# per (path, year); per-path summaries (CAGR, average withdrawal) always go to
+# small .npy files that the percentile tables are computed from. The 'shared'
+# format keeps every field in shared memory instead of files (directory unused).
+#
+# A store pickles as a reference, so pool workers given the store write their
+# chunks in place: .npy stores are reopened read-write ('r+') and shared-memory
+# stores are mapped again, with no results pickled back to the parent.
+
+# Per-(path, year) fields, keyed by the names used in sim3.py
+year_fields = {
+    'Begin Bal': 'begin_balance',
+    'Withdrawal': 'withdrawal',
+    'Net Begin': 'net_begin',
+    'Return': 'return',
+    'End Balance': 'end_balance',
+}
+
+# Per-path summaries
+path_fields = ('cagr', 'average_withdrawal')
+
+
+# Function to calculate the average withdrawal of each simulation over the
+# years it ran, from batched (years x paths) results
+def average_withdrawals(results):
+    withdrawals = results['Withdrawal']
+    n_years_run = np.sum(~np.isnan(withdrawals), axis=0)
+    return np.nansum(withdrawals, axis=0) / n_years_run
+
+
+class ResultStore:
+    def __init__(self, directory, n_paths, n_years, output_format='npy', mode='w'):
+        if output_format not in ('npy', 'parquet', 'shared'):
+            raise ValueError(f"Unknown output format: {output_format}")
+
+        self.directory = directory
+        self.n_paths = n_paths
+        self.n_years = n_years
+        self.output_format = output_format
+        self._parquet_writer = None
+        self._shared = {}
+
+        if output_format == 'shared':
+            shared = {name: SharedArray((n_paths,)) for name in path_fields}
+            shared.update({name: SharedArray((n_paths, n_years)) for name in year_fields.values()})
+            self._paths = {name: shared[name].array for name in path_fields}
+            self._years = {name: shared[name].array for name in year_fields.values()}
+            self._shared = shared
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        if mode == 'w':
+            with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+                json.dump({'n_paths': n_paths, 'n_years': n_years, 'output_format': output_format}, f)
+
+        self._paths = {
+            name: self._open(name, (n_paths,), mode) for name in path_fields
+        }
+        self._years = {}
+        if output_format == 'npy':
+            self._years = {
+                name: self._open(name, (n_paths, n_years), mode) for name in year_fields.values()
+            }
+
+    def _open(self, name, shape, mode):
+        filename = os.path.join(self.directory, f"{name}.npy")
+        if mode == 'w':
+            return np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64, shape=shape)
+        return np.load(filename, mmap_mode=mode)
+
+    def __getstate__(self):
+        if self.output_format == 'parquet':
+            raise TypeError("A Parquet result store cannot be shared with other processes")
+        state = {'directory': self.directory, 'n_paths': self.n_paths, 'n_years': self.n_years,
+                 'output_format': self.output_format}
+        if self.output_format == 'shared':
+            state['shared'] = self._shared
+        return state
+
+    def __setstate__(self, state):
+        shared = state.pop('shared', None)
+        if shared is None:
+            self.__init__(**state, mode='r+')
+            return
+        self.__dict__.update(state)
+        self._parquet_writer = None
+        self._paths = {name: shared[name].array for name in path_fields}
+        self._years = {name: shared[name].array for name in year_fields.values()}
+        self._shared = shared
+
+    # Function to write the batched results (years x paths arrays) of the
+    # simulations starting at path index start
+    def write_chunk(self, start, results):
+        n_chunk = results['CAGR'].shape[0]
+        stop = start + n_chunk
+
+        self._paths['cagr'][start:stop] = results['CAGR']
+        self._paths['average_withdrawal'][start:stop] = average_withdrawals(results)
+
+        if self.output_format == 'parquet':
+            self._write_parquet_chunk(start, results)
+        else:
+            for field, name in year_fields.items():
+                self._years[name][start:stop] = results[field].T
+
+    # Function to get writable views of paths start:stop in the batched layout
+    # ((years x paths) per field and CAGR per path), so a simulation can write
+    # its results straight into the store; call summarize_chunk afterwards
+    def chunk_views(self, start, stop):
+        if self.output_format == 'parquet':
+            raise ValueError("Results cannot be written in place into a Parquet store")
+        views = {field: self._years[name][start:stop].T for field, name in year_fields.items()}
+        views['CAGR'] = self._paths['cagr'][start:stop]
+        return views
+
+    # Function to fill in the per-path summaries of paths written in place
+    # (from a contiguous copy of the withdrawals, so the sums match write_chunk's)
+    def summarize_chunk(self, start, stop):
+        withdrawals = np.ascontiguousarray(self.chunk_views(start, stop)['Withdrawal'])
+        self._paths['average_withdrawal'][start:stop] = average_withdrawals({'Withdrawal': withdrawals})
+
+    def _write_parquet_chunk(self, start, results):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # One row per (path, year) that was actually simulated
+        n_chunk = results['CAGR'].shape[0]
+        years, paths = np.nonzero(~np.isnan(results['Begin Bal']))
+        columns = {'path': start + paths, 'year': years + 1}
+        for field, name in year_fields.items():
+            columns[name] = results[field][years, paths]
+
+        order = np.lexsort((columns['year'], columns['path']))
+        table = pa.table({name: values[order] for name, values in columns.items()})
+
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(os.path.join(self.directory, 'results.parquet'), table.schema)
+        self._parquet_writer.write_table(table, row_group_size=max(n_chunk * self.n_years, 1))
+
+    # Shared-memory stores are released by close(): use their results first
+    def close(self):
+        for array in list(self._paths.values()) + list(self._years.values()):
+            if isinstance(array, np.memmap):
+                array.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._shared:
+            self._paths, self._years = {}, {}
+            for array in self._shared.values():
+                array.close()
+            self._shared = {}
+
+    # Function to read a per-path summary ('cagr' or 'average_withdrawal')
+    def path_summary(self, name):
+        return self._paths[name]
+
+    # Function to read a per-(path, year) field as a (paths x years) array
+    def year_field(self, field):
+        name = year_fields.get(field, field)
+        if self.output_format != 'parquet':
+            return self._years[name]
+
+        data = pd.read_parquet(os.path.join(self.directory, 'results.parquet'), columns=['path', 'year', name])
+        values = np.full((self.n_paths, self.n_years), np.nan)
+        values[data['path'].to_numpy(), data['year'].to_numpy() - 1] = data[name].to_numpy()
+        return values
+
+    # Function to calculate percentiles of a per-path summary
+    def percentiles(self, name, percentiles):
+        return np.percentile(self.path_summary(name), percentiles)
+
+    # Function to lay out the results in the wide one-row-per-simulation format
+    # (only sensible for small runs)
+    def to_wide_dataframe(self):
+        fields = {field: self.year_field(field) for field in year_fields}
+        columns = {}
+        for year in range(self.n_years):
+            for field in year_fields:
+                columns[f'Year {year + 1} {field}'] = fields[field][:, year]
+        columns['CAGR'] = self.path_summary('cagr')
+        return pd.DataFrame(columns)
+
+
+# Function to reopen an existing store for reading ('r+' to also write .npy fields)
+def open_result_store(directory, mode='r'):
+    with open(os.path.join(directory, 'metadata.json')) as f:
+        metadata = json.load(f)
+    return ResultStore(
+        directory, metadata['n_paths'], metadata['n_years'], metadata['output_format'], mode=mode
+    )
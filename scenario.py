@@ -0,0 +1,134 @@
+import dataclasses
+import json
+import math
+from dataclasses import dataclass
+
+from generators import make_generator
+from policies import policy_specs
+from portfolio import Portfolio
+from scenario_bank import bank_key, get_returns
+
+# Scenario configuration shared by the library functions in analyses.py and
+# the batch CLI in main.py. Defaults match the assumptions the scripts use.
+
+
+@dataclass(frozen=True)
+class Scenario:
+    # Investment parameters (decimal form)
+    mean: float = 0.1048            # Expected annual return (10.48%)
+    std_dev: float = 0.1272         # Annual standard deviation (12.72%)
+    fee: float = 0.012              # Annual fee (1.2%)
+    inflation: float = 0.03         # Returns are real (inflation-adjusted)
+
+    # Simulation parameters
+    n_years: int = 30
+    n_simulations: int = 2000
+    seed: int = 2024                # Seed for the scenario bank and the guardrail simulations
+    chunk_size: int = 500           # Simulations per chunk (each chunk gets its own random stream)
+    sampling: str = 'mc'            # Normal draws for the scenario bank: 'mc', 'antithetic' or 'sobol'
+
+    # Return model (see generators.py)
+    return_model: str = 'normal'    # 'normal', 'lognormal', 'student_t', 'bootstrap' or 'regime'
+    t_df: float = 5                 # Degrees of freedom for 'student_t'
+    history_file: str = None        # CSV of annual nominal returns for 'bootstrap' (fee and inflation are subtracted)
+    block_size: int = 5             # Years per bootstrap block
+    portfolio: Portfolio = None     # Multi-asset portfolio (portfolio.py) instead of the single asset above
+
+    # Portfolio and withdrawal
+    initial_portfolio: float = 1000000
+    withdrawal_amount: float = 45991
+    target_percentages: tuple = (85, 75, 95)
+
+    # Guardrail parameters
+    target_success_rate: float = 85
+    lower_threshold: float = 75
+    upper_threshold: float = 95
+    withdrawal_cap: float = None
+    withdrawal_floor: float = None
+    n_surface_simulations: int = 10000
+
+    # Withdrawal policy of the guardrail simulation (see policies.py)
+    withdrawal_policy: str = 'probability'  # 'probability', 'guyton_klinger', 'constant_percentage', 'vpw' or 'constant'
+    policy_rate: float = None               # Withdrawal rate (or expected real return for 'vpw'); None uses the default
+    compared_policies: tuple = None         # Policies for policy_comparison: names, or label -> rate or options
+                                            # (see policies.policy_specs); None compares every policy
+
+    # Mean real return after fees and inflation
+    @property
+    def real_mean(self):
+        return self.mean - self.fee - self.inflation
+
+    # True when returns come from the single-asset normal model
+    @property
+    def normal_returns(self):
+        return self.return_model == 'normal' and self.portfolio is None
+
+    # Function to build the generator of real returns for the return model or portfolio
+    # start_year: first calendar year of the returns (for a portfolio glide path
+    # over n_years, e.g. n_years - years_remaining)
+    def return_generator(self, start_year=0):
+        if self.portfolio is not None:
+            if self.return_model != 'normal':
+                raise ValueError("Portfolio returns are correlated normals; return_model must be 'normal'")
+            return self.portfolio.generator(self.fee + self.inflation, start_year, self.n_years)
+        return make_generator(
+            self.return_model, self.real_mean, self.std_dev, self.t_df, self.history_file, self.block_size,
+            history_shift=self.fee + self.inflation,
+        )
+
+    # Function to fetch the simulated real returns (years x simulations) from the scenario bank
+    def returns(self, n_years=None):
+        return get_returns(*self._bank_arguments(n_years))
+
+    # Function to build the scenario bank key of the returns (scenarios with the
+    # same key share one return matrix)
+    def returns_key(self, n_years=None):
+        return bank_key(*self._bank_arguments(n_years))
+
+    def _bank_arguments(self, n_years=None):
+        n_years = self.n_years if n_years is None else n_years
+        generator = None if self.normal_returns else self.return_generator()
+        return (self.mean, self.std_dev, self.fee, self.inflation, n_years, self.n_simulations, self.seed,
+                self.sampling, generator)
+
+    def replace(self, **changes):
+        return dataclasses.replace(self, **changes)
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    # Function to build a scenario from a dict such as a JSON object or CSV row
+    # Empty values keep the default; lists may be given as JSON strings
+    # A seed of null (or "none" in a CSV) draws fresh, uncached returns
+    @classmethod
+    def from_dict(cls, values):
+        fields = {field.name: field for field in dataclasses.fields(cls)}
+        unknown = set(values) - set(fields)
+        if unknown:
+            raise ValueError(f"Unknown scenario fields: {', '.join(sorted(unknown))}")
+
+        kwargs = {}
+        for name, value in values.items():
+            if name == 'seed' and (value is None or str(value).lower() == 'none'):
+                kwargs[name] = None
+                continue
+            if value is None or value == '' or (isinstance(value, float) and math.isnan(value)):
+                continue
+            if name == 'portfolio':
+                if isinstance(value, str):
+                    value = json.loads(value)
+                value = value if isinstance(value, Portfolio) else Portfolio.from_dict(value)
+            elif name == 'compared_policies':
+                if isinstance(value, str):
+                    value = json.loads(value)
+                value = policy_specs(value)
+            elif name == 'target_percentages':
+                if isinstance(value, str):
+                    value = json.loads(value)
+                value = tuple(value) if isinstance(value, (list, tuple)) else (value,)
+            elif fields[name].type is int:
+                value = int(value)
+            elif fields[name].type is float:
+                value = float(value)
+            kwargs[name] = value
+        return cls(**kwargs)
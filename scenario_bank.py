@@ -0,0 +1,86 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from estimators import sample_returns
+
+# Bank of simulated return matrices for common-random-numbers runs.
+# Each (years x simulations) matrix is generated once from a seeded
+# np.random.Generator and handed out to every evaluation with the same market
+# assumptions, so trial withdrawals are compared on identical scenarios.
+# Matrices are read-only and the least recently used ones are evicted once the
+# bank holds more than max_bytes.
+
+
+class ScenarioBank:
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._matrices = OrderedDict()
+
+    # Function to fetch (or generate and store) the return matrix for a scenario
+    # Returns are mean - fee - inflation + std_dev * N(0, 1), with the normals
+    # drawn by a sampling method from estimators.py ('mc', 'antithetic' or 'sobol'),
+    # or come from a return generator (generators.py) built for those assumptions
+    def get(self, mean, std_dev, fee, inflation, n_years, n_simulations, seed, sampling='mc', generator=None):
+        key = bank_key(mean, std_dev, fee, inflation, n_years, n_simulations, seed, sampling, generator)
+        if key in self._matrices:
+            self._matrices.move_to_end(key)
+            return self._matrices[key]
+
+        rng = np.random.default_rng(seed)
+        if generator is None:
+            returns = sample_returns(mean - fee - inflation, std_dev, n_years, n_simulations, sampling, rng)
+        else:
+            returns = generator.generate(n_years, n_simulations, rng)
+
+        # Unseeded draws are fresh on every call, so they are not kept
+        if seed is not None:
+            self.put(key, returns)
+        return returns
+
+    # Function to store a return matrix generated elsewhere (e.g. in shared memory)
+    # under its bank_key, so get() hands it out instead of generating it again
+    def put(self, key, returns):
+        self.discard(key)
+        returns.setflags(write=False)
+        self._matrices[key] = returns
+        self.n_bytes += returns.nbytes
+
+        # Evict the least recently used matrices, always keeping the newest one
+        while self.n_bytes > self.max_bytes and len(self._matrices) > 1:
+            _, evicted = self._matrices.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+
+    # Function to drop a matrix from the bank, if present
+    def discard(self, key):
+        returns = self._matrices.pop(key, None)
+        if returns is not None:
+            self.n_bytes -= returns.nbytes
+
+    def clear(self):
+        self._matrices.clear()
+        self.n_bytes = 0
+
+    def __contains__(self, key):
+        return key in self._matrices
+
+    def __len__(self):
+        return len(self._matrices)
+
+
+# Function to build the key a return matrix is stored under
+def bank_key(mean, std_dev, fee, inflation, n_years, n_simulations, seed, sampling='mc', generator=None):
+    if generator is not None and sampling != 'mc':
+        raise ValueError("Sampling methods other than 'mc' apply to the normal return model only")
+    return (mean, std_dev, fee, inflation, n_years, n_simulations, seed, sampling,
+            None if generator is None else generator.key)
+
+
+# Bank shared by the simulation scripts
+default_bank = ScenarioBank()
+
+
+# Function to fetch a return matrix from the shared bank
+def get_returns(mean, std_dev, fee, inflation, n_years, n_simulations, seed, sampling='mc', generator=None):
+    return default_bank.get(mean, std_dev, fee, inflation, n_years, n_simulations, seed, sampling, generator)
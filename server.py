@@ -0,0 +1,451 @@
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from analyses import analyses, run_analysis
+from main import to_jsonable
+from result_cache import ResultCache, cache_dir, cache_key, default_max_bytes
+from scenario import Scenario
+from scenario_bank import default_bank
+
+# Local scenario service: an asyncio front end that accepts scenario requests
+# over a socket and runs them on a persistent pool of worker processes, so each
+# answer costs the analysis alone and not a cold script launch.
+#
+#   python server.py --port 8765 --workers 4
+#
+# The protocol is JSON Lines, one request per line, in the same shape as a
+# main.py scenario file (Scenario fields plus id and analysis):
+#   {"id": "a", "analysis": "optimal_withdrawal", "fee": 0.01, "target_percentages": [85]}
+# and one response per line, in completion order:
+#   {"id": "a", "analysis": ..., "result": ... or "error": ..., "batch_size": n,
+#    "queued_seconds": ..., "run_seconds": ..., "seconds": ...}
+# {"command": "stats"} answers with job counts and latency percentiles.
+#
+# Requests arriving within batch_window of each other are batched: requests
+# that read the same return matrix (same market assumptions, horizon, path
+# count and seed) go to one worker together, and identical requests are run
+# once. The matrix is generated once in shared memory and every worker maps it
+# into its scenario bank instead of receiving a pickled copy. At most
+# max_pending requests wait in the queue and two batches per worker are in
+# flight; beyond that the server stops reading from its connections, so
+# clients are slowed down instead of the server running out of memory.
+# It listens on localhost (or a Unix socket) only.
+
+# Quick analyses that read nothing but the scenario bank's return matrix, batched
+# by that matrix. The others (guardrail_simulation and policy_comparison draw
+# their own chunk streams) run as separate jobs, so heavy requests spread
+# across the workers.
+shared_analyses = ('optimal_withdrawal', 'required_portfolio')
+
+# Shared return matrices each worker keeps mapped
+max_attached = 8
+
+# Shared-memory blocks mapped by this (worker) process: name -> (bank key, block, matrix)
+attached = OrderedDict()
+
+
+# Function to map a shared return matrix into this process's scenario bank
+# shared: (bank key, block name, shape, dtype) as made by SharedReturns.acquire
+def attach_returns(shared):
+    key, name, shape, dtype = shared
+    if name not in attached:
+        block = shared_memory.SharedMemory(name=name)
+        attached[name] = (key, block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    attached.move_to_end(name)
+    key, _, returns = attached[name]
+    if key not in default_bank:
+        default_bank.put(key, returns)
+
+    # Unmap the least recently used blocks (the server may already have unlinked them)
+    while len(attached) > max_attached:
+        _, (old_key, old_block, _) = attached.popitem(last=False)
+        default_bank.discard(old_key)
+        try:
+            old_block.close()
+        except BufferError:  # Still referenced; unmapped when the last view goes
+            pass
+
+
+# Function run in a worker process: run a batch of (analysis, scenario) jobs
+# Returns (result, error, run seconds) per job; results are JSON-compatible
+def run_jobs(jobs, shared=None, cache_directory=None, cache_max_bytes=default_max_bytes):
+    if shared is not None:
+        attach_returns(shared)
+    cache = None if cache_directory is None else ResultCache(cache_directory, cache_max_bytes)
+
+    outcomes = []
+    for analysis, scenario in jobs:
+        start_time = time.perf_counter()
+        try:
+            outcomes.append((to_jsonable(run_analysis(analysis, scenario, cache)), None,
+                             time.perf_counter() - start_time))
+        except Exception as error:
+            outcomes.append((None, f"{type(error).__name__}: {error}", time.perf_counter() - start_time))
+    return outcomes
+
+
+# Function run once in each new worker so the first request does not pay for the imports
+def warm_up():
+    return os.getpid()
+
+
+class SharedReturns:
+    # Return matrices in shared memory, by scenario bank key. Blocks in use by
+    # a batch are pinned; the least recently used unpinned blocks are unlinked
+    # once more than max_bytes are held.
+    def __init__(self, max_bytes=1024 ** 3):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._blocks = OrderedDict()  # key -> [block, shape, dtype, pins]
+        self._lock = threading.Lock()
+
+    # Function to pin (creating if needed) the block of a scenario's returns
+    # Returns the (bank key, block name, shape, dtype) a worker attaches to
+    def acquire(self, scenario):
+        key = scenario.returns_key()
+        with self._lock:
+            if key in self._blocks:
+                entry = self._blocks[key]
+                entry[3] += 1
+                self._blocks.move_to_end(key)
+                return key, entry[0].name, entry[1], entry[2]
+
+        # Generate outside the lock, without keeping a copy in this process's bank
+        returns = scenario.returns()
+        default_bank.discard(key)
+        block = shared_memory.SharedMemory(create=True, size=max(returns.nbytes, 1))
+        np.ndarray(returns.shape, dtype=returns.dtype, buffer=block.buf)[...] = returns
+
+        with self._lock:
+            if key in self._blocks:  # Created by another batch meanwhile
+                block.close()
+                block.unlink()
+                entry = self._blocks[key]
+                entry[3] += 1
+            else:
+                entry = self._blocks[key] = [block, returns.shape, returns.dtype.str, 1]
+                self.n_bytes += block.size
+            return key, entry[0].name, entry[1], entry[2]
+
+    def release(self, key):
+        with self._lock:
+            self._blocks[key][3] -= 1
+            self._evict()
+
+    def _evict(self):
+        for key in list(self._blocks):
+            if self.n_bytes <= self.max_bytes:
+                break
+            block, _, _, pins = self._blocks[key]
+            if pins == 0:
+                del self._blocks[key]
+                self.n_bytes -= block.size
+                block.close()
+                block.unlink()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def close(self):
+        with self._lock:
+            for block, _, _, _ in self._blocks.values():
+                block.close()
+                block.unlink()
+            self._blocks.clear()
+            self.n_bytes = 0
+
+
+class Job:
+    def __init__(self, row, index):
+        row = dict(row)
+        self.id = to_jsonable(row.pop('id', index))
+        self.analysis = row.pop('analysis', None)
+        self.received = time.perf_counter()
+        self.dispatched = None
+        self.batch_size = None
+        self.future = asyncio.get_running_loop().create_future()
+
+        if self.analysis not in analyses:
+            raise ValueError(f"Unknown analysis: {self.analysis!r} (choose from {', '.join(analyses)})")
+        self.scenario = Scenario.from_dict(row)
+
+        # Requests reading the same return matrix are batched together
+        self.identity = cache_key(self.analysis, self.scenario)
+        if self.analysis in shared_analyses:
+            self.batch_key = ('returns', self.scenario.returns_key())
+        else:
+            self.batch_key = ('job', self.identity)
+
+
+class JobServer:
+    def __init__(self, workers=None, max_pending=1000, batch_window=0.005, max_batch=64,
+                 shared_bytes=1024 ** 3, cache=None):
+        self.workers = workers or os.cpu_count()
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache = cache
+        self.queue = asyncio.Queue(max_pending)
+        self.slots = asyncio.Semaphore(2 * self.workers)  # Batches in flight
+        self.shared = SharedReturns(shared_bytes)
+        self.pool = None
+        self.pool_lock = asyncio.Lock()
+
+        self.latencies = deque(maxlen=10000)
+        self.counts = {'jobs': 0, 'failed': 0, 'batches': 0, 'deduplicated': 0}
+        self._next_index = 0
+
+    # Function to start the worker processes (spawned: the event loop's threads are not forked)
+    async def start_pool(self):
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=mp.get_context('spawn'))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.pool, warm_up) for _ in range(self.workers)))
+
+    # Function to replace a broken pool once, however many batches saw it break
+    async def restart_pool(self, broken):
+        async with self.pool_lock:
+            if self.pool is broken:
+                broken.shutdown(wait=False)
+                await self.start_pool()
+
+    # Function to serve on host:port, or on a Unix socket at path, until cancelled
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        # SIGTERM (timeout, systemd, docker stop) shuts down the same way as Ctrl+C
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, RuntimeError, ValueError):  # No signal handlers here (Windows, not the main thread)
+            pass
+
+        dispatcher = None
+        try:
+            await self.start_pool()
+            if path is not None:
+                server = await asyncio.start_unix_server(self.handle_connection, path)
+            else:
+                server = await asyncio.start_server(self.handle_connection, host, port)
+            dispatcher = asyncio.create_task(self.dispatch())
+            async with server:
+                await server.serve_forever()
+        finally:
+            if dispatcher is not None:
+                dispatcher.cancel()
+            self.close()
+            try:
+                loop.remove_signal_handler(signal.SIGTERM)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        self.shared.close()
+
+    # Function to read requests from one connection and write a response for each
+    async def handle_connection(self, reader, writer):
+        responses = set()
+        try:
+            while line := await reader.readline():
+                if not line.strip():
+                    continue
+                row = None
+                try:
+                    row = json.loads(line)
+                    if row.get('command') == 'stats':
+                        await self.write(writer, self.stats())
+                        continue
+                    job = Job(row, self._next_index)
+                except Exception as error:
+                    response = {'error': f"{type(error).__name__}: {error}"}
+                    if isinstance(row, dict):
+                        response = {'id': to_jsonable(row.get('id', self._next_index)), **response}
+                    await self.write(writer, response)
+                    continue
+                finally:
+                    self._next_index += 1
+
+                # Waits while the queue is full, which stops reading from the client
+                await self.queue.put(job)
+                response = asyncio.create_task(self.respond(job, writer))
+                responses.add(response)
+                response.add_done_callback(responses.discard)
+            if responses:
+                await asyncio.wait(responses)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def write(self, writer, message):
+        writer.write((json.dumps(message) + '\n').encode())
+        await writer.drain()
+
+    # Function to wait for a job and write its result and latency
+    async def respond(self, job, writer):
+        response = {'id': job.id, 'analysis': job.analysis}
+        try:
+            result, error, run_seconds = await job.future
+        except Exception as failure:
+            result, error, run_seconds = None, f"{type(failure).__name__}: {failure}", None
+        if error is None:
+            response['result'] = result
+        else:
+            response['error'] = error
+            self.counts['failed'] += 1
+
+        seconds = time.perf_counter() - job.received
+        self.latencies.append(seconds)
+        response.update({
+            'batch_size': job.batch_size,
+            'queued_seconds': None if job.dispatched is None else job.dispatched - job.received,
+            'run_seconds': run_seconds,
+            'seconds': seconds,
+        })
+        await self.write(writer, response)
+
+    # Function to take queued jobs, batch those arriving within batch_window
+    # of each other and send each batch to the pool
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(jobs) < self.max_batch:
+                try:
+                    jobs.append(await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            batches = {}
+            for job in jobs:
+                batches.setdefault(job.batch_key, []).append(job)
+            for batch_key, batch in batches.items():
+                await self.slots.acquire()
+                asyncio.create_task(self.run_batch(batch_key, batch))
+
+    # Function to run one batch on the pool and hand out the results
+    async def run_batch(self, batch_key, batch):
+        loop = asyncio.get_running_loop()
+        shared = None
+        pool = self.pool
+        try:
+            if batch_key[0] == 'returns':
+                shared = await loop.run_in_executor(None, self.shared.acquire, batch[0].scenario)
+
+            # Identical jobs are run once
+            unique = {}
+            for job in batch:
+                unique.setdefault(job.identity, job)
+            self.counts['deduplicated'] += len(batch) - len(unique)
+
+            dispatched = time.perf_counter()
+            for job in batch:
+                job.dispatched = dispatched
+                job.batch_size = len(batch)
+            cache = None if self.cache is None else (self.cache.directory, self.cache.max_bytes)
+            outcomes = await loop.run_in_executor(
+                pool, run_jobs, [(job.analysis, job.scenario) for job in unique.values()], shared, *(cache or ())
+            )
+            results = dict(zip(unique, outcomes))
+            for job in batch:
+                job.future.set_result(results[job.identity])
+        except Exception as error:
+            if isinstance(error, BrokenProcessPool):
+                # A worker died: later batches get a fresh pool
+                await self.restart_pool(pool)
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_exception(error)
+        finally:
+            if shared is not None:
+                self.shared.release(shared[0])
+            self.counts['jobs'] += len(batch)
+            self.counts['batches'] += 1
+            self.slots.release()
+
+    # Function to summarize the jobs run so far (latencies of the last 10,000 in seconds)
+    def stats(self):
+        stats = dict(self.counts, pending=self.queue.qsize(), workers=self.workers,
+                     shared_returns=len(self.shared))
+        if self.latencies:
+            latencies = np.asarray(self.latencies)
+            stats['latency'] = {
+                'mean': latencies.mean(),
+                **{f"p{p}": np.percentile(latencies, p) for p in (50, 95, 99)},
+                'max': latencies.max(),
+            }
+        return to_jsonable(stats)
+
+
+# Function to send scenario rows to a running server and collect the responses
+# (in completion order)
+async def submit(rows, host='127.0.0.1', port=8765, path=None):
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    async def send():
+        for row in rows:
+            writer.write((json.dumps(row) + '\n').encode())
+            await writer.drain()
+        writer.write_eof()
+
+    sender = asyncio.create_task(send())
+    responses = [json.loads(line) async for line in reader]
+    await sender
+    writer.close()
+    return responses
+
+
+# Function to run submit from synchronous code
+def query(rows, host='127.0.0.1', port=8765, path=None):
+    return asyncio.run(submit(rows, host, port, path))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve retirement withdrawal scenarios on a local socket.")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=8765, help="Port to listen on (default: %(default)s)")
+    parser.add_argument('--socket', help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="Worker processes (default: %(default)s)")
+    parser.add_argument('--max-pending', type=int, default=1000,
+                        help="Queued requests before the server stops reading (default: %(default)s)")
+    parser.add_argument('--batch-window', type=float, default=5,
+                        help="Milliseconds to wait for requests to batch together (default: %(default)s)")
+    parser.add_argument('--shared-size', type=float, default=1024,
+                        help="Shared-memory return matrices limit in MB (default: %(default)s)")
+    parser.add_argument('--cache-dir', default=cache_dir, help="Result cache directory (default: %(default)s)")
+    parser.add_argument('--cache-size', type=float, default=default_max_bytes / 1024 ** 2,
+                        help="Result cache size limit in MB (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true', help="Recompute every request")
+    args = parser.parse_args(argv)
+
+    server = JobServer(
+        args.workers, args.max_pending, args.batch_window / 1000, shared_bytes=int(args.shared_size * 1024 ** 2),
+        cache=None if args.no_cache else ResultCache(args.cache_dir, int(args.cache_size * 1024 ** 2)),
+    )
+    where = args.socket or f"{args.host}:{args.port}"
+    print(f"Serving scenarios on {where} with {server.workers} workers", file=sys.stderr)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.socket))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
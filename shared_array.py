@@ -0,0 +1,47 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# NumPy arrays in multiprocessing.shared_memory, for handing large inputs and
+# outputs to pool workers without pickling them. A SharedArray pickles as a
+# reference (block name, shape and dtype): the worker maps the same memory and
+# reads or writes the array in place. The process that created the array
+# removes the block on close().
+
+
+class SharedArray:
+    def __init__(self, shape, dtype=np.float64):
+        self.shape = tuple(int(size) for size in shape)
+        self.dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(self.shape)) * self.dtype.itemsize, 1))
+        self._owner = True
+        self._attach(block)
+
+    # The array is set before the block so it is released first when the object goes away
+    def _attach(self, block):
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf)
+        self._block = block
+
+    def __getstate__(self):
+        return {'name': self._block.name, 'shape': self.shape, 'dtype': self.dtype.str}
+
+    def __setstate__(self, state):
+        self.shape = tuple(state['shape'])
+        self.dtype = np.dtype(state['dtype'])
+        self._owner = False
+        self._attach(shared_memory.SharedMemory(name=state['name']))
+
+    @property
+    def name(self):
+        return self._block.name
+
+    # Function to unmap the array (and remove the block in the creating process)
+    def close(self):
+        self.array = None
+        try:
+            self._block.close()
+        except BufferError:  # Views of the array are still alive; unmapped once they are gone
+            pass
+        if self._owner:
+            self._block.unlink()
+            self._owner = False
@@ -1,59 +1,177 @@
 import numpy as np
 import pandas as pd
 
+from engine import success_rate
+from estimators import estimate_success_rate, sample_returns, sampling_methods, sequential_success_rate
+from generators import make_generator
+from result_cache import cache_key, default_cache
+from grid import withdrawal_grid
+from instrument import Tracer, get_tracer, set_tracer
+from scenario_bank import get_returns
+from sweep import solve_for_target
+
 # Define the mean and standard deviation (in decimal form)
 mean = 0.1048  # 10.48%
 fee = .012
-mean = mean - fee
 std_dev = 0.1272  # 12.72%
+inflation = 0.03  # Using 3% inflation to get real return
 
 # Define the number of years and simulations
 n_years = 30  # 30-year period
 n_simulations = 2000  # 2000 simulations
 
-# Function to simulate returns and calculate the percentage of ending values > 0
-def simulate_withdrawals(withdrawal_amount):
-    # Step 1: Generate returns using the equivalent formula to Excel
-    excel_style_returns = (mean - 0.03) + std_dev * np.random.normal(0, 1, (n_years, n_simulations))  # Using 3% inflation to get real return
+# Initial investment of $1,000,000
+initial_investment = 1000000
+
+# 'sorted' reads each target off the sorted per-path maximum withdrawals of one
+# set of simulations, 'bisect' searches by re-simulating at every trial amount,
+# 'brent' finds the amount with a bracketed root finder (secant / inverse
+# quadratic steps) on the success curve in a handful of simulations, starting
+# from the previous answer in sweep_optimal_withdrawals
+solver = 'sorted'
+
+# Seed for the scenario bank: every evaluation reuses the same simulated returns
+# (common random numbers). Set to None to draw fresh returns for every evaluation.
+seed = 2024
+
+# Success-rate estimator (see estimators.py): 'mc', 'antithetic', 'sobol'
+# (requires scipy) or 'control'. The last three reach the precision of 'mc'
+# with fewer simulations; 'antithetic' and 'sobol' also apply to the sorted solver.
+estimator = 'mc'
+
+# Return model (see generators.py): 'normal', 'lognormal', 'student_t',
+# 'bootstrap' (block bootstrap of the annual nominal returns in history_file)
+# or 'regime' (calm/stressed regime switching). Models other than 'normal'
+# use the 'mc' estimator.
+return_model = 'normal'
+t_df = 5                # Degrees of freedom for 'student_t'
+history_file = None     # CSV of annual returns for 'bootstrap'; fee and inflation are subtracted
+block_size = 5          # Years per bootstrap block
 
-    # Step 2: Initialize the portfolio values with the initial investment of $1,000,000
-    initial_investment = 1000000
-    ending_values = []  # To store the final ending balance for each simulation
+# Multi-asset portfolio (portfolio.Portfolio; import it to set one) used instead of mean / std_dev, e.g.
+# Portfolio(means=(0.1048, 0.045), std_devs=(0.1272, 0.06),
+#           correlation=((1, 0.1), (0.1, 1)), weights=(0.6, 0.4))
+portfolio = None
 
-    # Step 3: Simulate each year's portfolio values
-    for simulation in range(n_simulations):
-        portfolio_value = initial_investment
+# Early exit for the 'bisect' solver: each trial amount simulates batches of
+# paths and stops once a confidence interval puts the success rate clearly
+# above or below the target band ('mc' estimator only)
+early_exit = True
+early_exit_batch = 200          # Paths per batch
+early_exit_confidence = 99.9    # Confidence level (%) of the interval
 
-        for year in range(n_years):
-            # Subtract the withdrawal
-            portfolio_value -= withdrawal_amount
-            if portfolio_value <= 0:
-                portfolio_value = 0
-                break  # Stop if portfolio is depleted
+# Reuse the results of an earlier run with the same settings (seeded runs only;
+# stored in result_cache.cache_dir)
+use_cache = True
 
-            # Apply the return for that year
-            annual_return = excel_style_returns[year, simulation]
-            portfolio_value *= (1 + annual_return)
+# Set to a file name (e.g. 'trace.json') to record call counts, stage times and
+# bisection iterations per target
+trace_file = None
+
+# Function to build the generator for a return model other than 'normal' or
+# for the portfolio (None for the single-asset normal model)
+def get_return_generator():
+    if return_model == 'normal' and portfolio is None:
+        return None
+    if estimator != 'mc':
+        raise ValueError(f"estimator = {estimator!r} requires the single-asset normal return model")
+    if portfolio is not None:
+        return portfolio.generator(shift=fee + inflation)
+    return make_generator(
+        return_model, mean - fee - inflation, std_dev, t_df, history_file, block_size, history_shift=fee + inflation
+    )
+
+# Function to collect every setting the results depend on, for the result cache
+def cache_inputs():
+    return {
+        'mean': mean, 'initial_investment': initial_investment,
+        'fee': fee, 'std_dev': std_dev, 'inflation': inflation, 'n_years': n_years,
+        'n_simulations': n_simulations, 'solver': solver, 'seed': seed, 'estimator': estimator,
+        'early_exit': early_exit, 'early_exit_batch': early_exit_batch, 'early_exit_confidence': early_exit_confidence,
+        'return_model': return_model, 't_df': t_df, 'history_file': history_file, 'block_size': block_size,
+        'portfolio': portfolio,
+    }
+
+# Function to generate returns using the equivalent formula to Excel
+def get_simulated_returns(horizon=None):
+    horizon = n_years if horizon is None else horizon
+    generator = get_return_generator()
+    if seed is None:
+        if generator is not None:
+            return generator.generate(horizon, n_simulations)
+        return sample_returns(mean - fee - inflation, std_dev, horizon, n_simulations, sampling_methods[estimator])
+    return get_returns(
+        mean, std_dev, fee, inflation, horizon, n_simulations, seed, sampling_methods[estimator], generator
+    )
+
+# Function to simulate returns and calculate the percentage of ending values > 0
+# Given boundaries (success rates in %), stops early once the rate is clearly above or below each
+def simulate_withdrawals(withdrawal_amount, boundaries=None):
+    tracer = get_tracer()
+    tracer.count('simulate_withdrawals')
+
+    # Step 1: Generate returns using the equivalent formula to Excel
+    excel_style_returns = get_simulated_returns()
 
-        # Store the ending value of the portfolio for the simulation
-        ending_values.append(portfolio_value)
+    # Step 2: Calculate the percentage of simulations with a positive ending balance
+    if boundaries is not None and early_exit and estimator == 'mc':
+        percentage_above_zero, n_paths = sequential_success_rate(
+            excel_style_returns, initial_investment, withdrawal_amount, boundaries, early_exit_batch, early_exit_confidence
+        )
+        tracer.count('paths_simulated', n_paths)
+        return percentage_above_zero
 
-    # Step 4: Calculate the percentage of simulations with a positive ending balance
-    ending_values_array = np.array(ending_values)
-    percentage_above_zero = np.mean(ending_values_array > 0) * 100
+    tracer.count('paths_simulated', n_simulations)
+    if estimator == 'control':
+        percentage_above_zero, _ = estimate_success_rate(
+            excel_style_returns, initial_investment, withdrawal_amount, estimator, mean - fee - inflation, std_dev
+        )
+    else:
+        percentage_above_zero = success_rate(excel_style_returns, initial_investment, withdrawal_amount)
     return percentage_above_zero
 
+# Function to solve the optimal withdrawal for every combination of target percentage and horizon
+# (all horizons are prefixes of the same simulations of the longest one)
+def find_withdrawal_grid(target_percentages, horizons):
+    excel_style_returns = get_simulated_returns(max(horizons))
+    return withdrawal_grid(excel_style_returns, initial_investment, target_percentages, horizons)
+
+# Function to read the optimal withdrawal amounts for target percentages off one set of simulations
+def find_optimal_withdrawals_sorted(target_percentages):
+    return find_withdrawal_grid(target_percentages, [n_years]).loc[n_years].to_dict()
+
+# Root search for the optimal withdrawal amount, warm-started from guess if given
+# Stops within one simulation's share of the target success rate
+def find_optimal_withdrawal_brent(target_percentage, guess=None, tolerance=0.01):
+    optimal_withdrawal, evaluations = solve_for_target(
+        simulate_withdrawals, target_percentage, (10000, 100000), guess, tolerance, 100 / n_simulations
+    )
+    print(f"Found withdrawal: ${optimal_withdrawal:.2f} in {evaluations} simulations (Target: {target_percentage}%)")
+    get_tracer().event('root_search', target=target_percentage, evaluations=evaluations,
+                       warm_start=guess is not None, result=optimal_withdrawal)
+    return optimal_withdrawal
+
 # Binary search to find the optimal withdrawal amount for a given target percentage
-def find_optimal_withdrawal(target_percentage, tolerance=0.01):  # Reduced tolerance for finer search
+# guess: answer of a neighbouring scenario, used by the 'brent' solver
+def find_optimal_withdrawal(target_percentage, tolerance=0.01, guess=None):  # Reduced tolerance for finer search
+    if solver == 'sorted':
+        return find_optimal_withdrawals_sorted([target_percentage])[target_percentage]
+    if solver == 'brent':
+        return find_optimal_withdrawal_brent(target_percentage, guess, tolerance)
+
     low = 10000  # Lower bound for withdrawal amount
     high = 100000  # Upper bound for withdrawal amount
     best_withdrawal = (low + high) / 2
     withdrawals_in_range = []  # To store withdrawals within the tolerance range
     tolerance_percentage = 0.5  # Tolerance for the percentage range
+    iterations = 0
 
     while high - low > tolerance:
         mid = (low + high) / 2
-        percentage_above_zero = simulate_withdrawals(mid)
+        iterations += 1
+        percentage_above_zero = simulate_withdrawals(mid, (
+            target_percentage - tolerance_percentage, target_percentage, target_percentage + tolerance_percentage
+        ))
 
         # Check if the percentage is within the tolerance range of the target
         if abs(percentage_above_zero - target_percentage) <= tolerance_percentage:
@@ -73,26 +191,67 @@ def find_optimal_withdrawal(target_percentage, tolerance=0.01):  # Reduced toler
     else:
         optimal_withdrawal = best_withdrawal  # If no values in range, return the last best value
 
+    get_tracer().event('bisection', target=target_percentage, iterations=iterations,
+                       in_range=len(withdrawals_in_range), result=optimal_withdrawal)
     return optimal_withdrawal
 
 # Find the optimal withdrawal amounts for multiple target percentages
 def find_withdrawals_for_targets(target_percentages):
+    tracer = get_tracer()
+    if solver == 'sorted':
+        with tracer.stage('find_optimal_withdrawals_sorted'):
+            optimal_withdrawals = find_optimal_withdrawals_sorted(target_percentages)
+        for target, optimal_withdrawal in optimal_withdrawals.items():
+            print(f"Optimal Withdrawal for {target}% success rate: ${optimal_withdrawal:.2f}")
+        return optimal_withdrawals
+
     optimal_withdrawals = {}
     for target in target_percentages:
         print(f"\nCalculating for target: {target}%")
-        optimal_withdrawal = find_optimal_withdrawal(target_percentage=target)
+        with tracer.stage('find_optimal_withdrawal'):
+            optimal_withdrawal = find_optimal_withdrawal(target_percentage=target)
         optimal_withdrawals[target] = optimal_withdrawal
         print(f"Optimal Withdrawal for {target}% success rate: ${optimal_withdrawal:.2f}")
     
     return optimal_withdrawals
 
-# Specify target percentages (85%, 75%, and 95%)
-target_percentages = [85, 75, 95]
+# Function to solve the optimal withdrawal for each value of one setting (e.g.
+# 'fee', 'inflation' or 'n_years'), in increasing order; with the 'brent'
+# solver each search starts from the answer for the previous value
+def sweep_optimal_withdrawals(target_percentage, parameter, values):
+    original_value = globals()[parameter]
+    optimal_withdrawals = {}
+    optimal_withdrawal = None
+    try:
+        for value in sorted(values):
+            globals()[parameter] = value
+            print(f"\nCalculating for {parameter} = {value}")
+            optimal_withdrawal = find_optimal_withdrawal(target_percentage, guess=optimal_withdrawal)
+            optimal_withdrawals[value] = optimal_withdrawal
+    finally:
+        globals()[parameter] = original_value
+    return optimal_withdrawals
+
+# Main execution block
+if __name__ == '__main__':
+    # Specify target percentages (85%, 75%, and 95%)
+    target_percentages = [85, 75, 95]
+
+    if trace_file:
+        set_tracer(Tracer())
+
+    # Run the process for all targets (or reuse the results of an identical earlier run)
+    if use_cache and seed is not None:
+        key = cache_key('sim1.find_withdrawals_for_targets', cache_inputs(), target_percentages=target_percentages)
+        optimal_withdrawals = default_cache.get_or_compute(key, lambda: find_withdrawals_for_targets(target_percentages))
+    else:
+        optimal_withdrawals = find_withdrawals_for_targets(target_percentages)
 
-# Run the process for all targets
-optimal_withdrawals = find_withdrawals_for_targets(target_percentages)
+    # Display the results
+    print("\nFinal optimal withdrawals for each target:")
+    for target, withdrawal in optimal_withdrawals.items():
+        print(f"{target}% success rate: ${withdrawal:.2f}")
 
-# Display the results
-print("\nFinal optimal withdrawals for each target:")
-for target, withdrawal in optimal_withdrawals.items():
-    print(f"{target}% success rate: ${withdrawal:.2f}")
\ No newline at end of file
+    if trace_file:
+        get_tracer().export(trace_file)
+        print(f"Trace saved to '{trace_file}'")
@@ -1,49 +1,175 @@
 import numpy as np
 import pandas as pd
 
+from engine import success_rate
+from estimators import estimate_success_rate, sample_returns, sampling_methods, sequential_success_rate
+from generators import make_generator
+from result_cache import cache_key, default_cache
+from grid import required_portfolio_grid
+from instrument import Tracer, get_tracer, set_tracer
+from scenario_bank import get_returns
+from sweep import solve_for_target
+
 # Define the mean and standard deviation (in decimal form)
 mean = 0.1048  # 10.48%
 fee = .012
-mean = mean - fee
 std_dev = 0.1272  # 12.72%
+inflation = 0.03  # Using 3% inflation to get real return
 
 # Define the number of years and simulations
 n_years = 20  # 29 years remaining
 n_simulations = 2000  # 2000 simulations
 
+# 'sorted' reads each target off the sorted per-path required balances of one
+# set of simulations, 'bisect' searches by re-simulating at every trial value,
+# 'brent' finds the value with a bracketed root finder (secant / inverse
+# quadratic steps) on the success curve in a handful of simulations, starting
+# from the previous answer in sweep_required_portfolios
+solver = 'sorted'
+
+# Seed for the scenario bank: every evaluation reuses the same simulated returns
+# (common random numbers). Set to None to draw fresh returns for every evaluation.
+seed = 2024
+
+# Success-rate estimator (see estimators.py): 'mc', 'antithetic', 'sobol'
+# (requires scipy) or 'control'. The last three reach the precision of 'mc'
+# with fewer simulations; 'antithetic' and 'sobol' also apply to the sorted solver.
+estimator = 'mc'
+
+# Return model (see generators.py): 'normal', 'lognormal', 'student_t',
+# 'bootstrap' (block bootstrap of the annual nominal returns in history_file)
+# or 'regime' (calm/stressed regime switching). Models other than 'normal'
+# use the 'mc' estimator.
+return_model = 'normal'
+t_df = 5                # Degrees of freedom for 'student_t'
+history_file = None     # CSV of annual returns for 'bootstrap'; fee and inflation are subtracted
+block_size = 5          # Years per bootstrap block
+
+# Multi-asset portfolio (portfolio.Portfolio; import it to set one) used instead of mean / std_dev, e.g.
+# Portfolio(means=(0.1048, 0.045), std_devs=(0.1272, 0.06),
+#           correlation=((1, 0.1), (0.1, 1)), weights=(0.6, 0.4))
+portfolio = None
+
+# Early exit for the 'bisect' solver: each trial amount simulates batches of
+# paths and stops once a confidence interval puts the success rate clearly
+# above or below the target band ('mc' estimator only)
+early_exit = True
+early_exit_batch = 200          # Paths per batch
+early_exit_confidence = 99.9    # Confidence level (%) of the interval
+
+# Reuse the results of an earlier run with the same settings (seeded runs only;
+# stored in result_cache.cache_dir)
+use_cache = True
+
+# Set to a file name (e.g. 'trace.json') to record call counts, stage times and
+# bisection iterations per target
+trace_file = None
+
+# Function to build the generator for a return model other than 'normal' or
+# for the portfolio (None for the single-asset normal model)
+def get_return_generator():
+    if return_model == 'normal' and portfolio is None:
+        return None
+    if estimator != 'mc':
+        raise ValueError(f"estimator = {estimator!r} requires the single-asset normal return model")
+    if portfolio is not None:
+        return portfolio.generator(shift=fee + inflation)
+    return make_generator(
+        return_model, mean - fee - inflation, std_dev, t_df, history_file, block_size, history_shift=fee + inflation
+    )
+
+# Function to collect every setting the results depend on, for the result cache
+def cache_inputs():
+    return {
+        'mean': mean,
+        'fee': fee, 'std_dev': std_dev, 'inflation': inflation, 'n_years': n_years,
+        'n_simulations': n_simulations, 'solver': solver, 'seed': seed, 'estimator': estimator,
+        'early_exit': early_exit, 'early_exit_batch': early_exit_batch, 'early_exit_confidence': early_exit_confidence,
+        'return_model': return_model, 't_df': t_df, 'history_file': history_file, 'block_size': block_size,
+        'portfolio': portfolio,
+    }
+
+# Function to generate returns using the equivalent formula to Excel
+def get_simulated_returns(horizon=None):
+    horizon = n_years if horizon is None else horizon
+    generator = get_return_generator()
+    if seed is None:
+        if generator is not None:
+            return generator.generate(horizon, n_simulations)
+        return sample_returns(mean - fee - inflation, std_dev, horizon, n_simulations, sampling_methods[estimator])
+    return get_returns(
+        mean, std_dev, fee, inflation, horizon, n_simulations, seed, sampling_methods[estimator], generator
+    )
+
 # Function to simulate returns and calculate the percentage of ending values > 0
-def simulate_withdrawals(portfolio_value, withdrawal_amount):
+# Given boundaries (success rates in %), stops early once the rate is clearly above or below each
+def simulate_withdrawals(portfolio_value, withdrawal_amount, boundaries=None):
+    tracer = get_tracer()
+    tracer.count('simulate_withdrawals')
+
     # Generate returns for 29 years
-    excel_style_returns = (mean - 0.03) + std_dev * np.random.normal(0, 1, (n_years, n_simulations))
-    
-    ending_balances = []
-
-    # Simulate each year's portfolio values
-    for simulation in range(n_simulations):
-        current_portfolio = portfolio_value
-        for year in range(n_years):
-            current_portfolio -= withdrawal_amount
-            if current_portfolio <= 0:
-                current_portfolio = 0
-                break  # Stop if portfolio is depleted
-            current_portfolio *= (1 + excel_style_returns[year, simulation])
-
-        ending_balances.append(current_portfolio)
-
-    # Calculate the percentage of simulations with a positive ending balance
-    percentage_above_zero = np.mean(np.array(ending_balances) > 0) * 100
+    excel_style_returns = get_simulated_returns()
+
+    # Simulate every path at once and calculate the percentage with a positive ending balance
+    if boundaries is not None and early_exit and estimator == 'mc':
+        percentage_above_zero, n_paths = sequential_success_rate(
+            excel_style_returns, portfolio_value, withdrawal_amount, boundaries, early_exit_batch, early_exit_confidence
+        )
+        tracer.count('paths_simulated', n_paths)
+        return percentage_above_zero
+
+    tracer.count('paths_simulated', n_simulations)
+    if estimator == 'control':
+        percentage_above_zero, _ = estimate_success_rate(
+            excel_style_returns, portfolio_value, withdrawal_amount, estimator, mean - fee - inflation, std_dev
+        )
+    else:
+        percentage_above_zero = success_rate(excel_style_returns, portfolio_value, withdrawal_amount)
     return percentage_above_zero
 
+# Function to solve the required portfolio for every combination of target percentage, horizon
+# and withdrawal amount (all horizons are prefixes of the same simulations of the longest one)
+def find_portfolio_grid(target_percentages, horizons, withdrawal_amounts):
+    excel_style_returns = get_simulated_returns(max(horizons))
+    return required_portfolio_grid(excel_style_returns, withdrawal_amounts, target_percentages, horizons)
+
+# Function to read the required portfolio values for target percentages off one set of simulations
+def find_required_portfolios_sorted(withdrawal_amount, target_percentages):
+    grid = find_portfolio_grid(target_percentages, [n_years], [withdrawal_amount])
+    return grid.loc[n_years][withdrawal_amount].to_dict()
+
+# Root search for the required portfolio value, warm-started from guess if given
+# Stops within one simulation's share of the target success rate
+def find_required_portfolio_brent(withdrawal_amount, target_percentage, guess=None, tolerance=0.01):
+    portfolio_value, evaluations = solve_for_target(
+        lambda value: simulate_withdrawals(value, withdrawal_amount),
+        target_percentage, (500000, 5000000), guess, tolerance, 100 / n_simulations
+    )
+    print(f"Found Portfolio: ${portfolio_value:.2f} in {evaluations} simulations (Target: {target_percentage}%)")
+    get_tracer().event('root_search', target=target_percentage, evaluations=evaluations,
+                       warm_start=guess is not None, result=portfolio_value)
+    return portfolio_value
+
 # Binary search to find the required portfolio value for target success rate
-def find_required_portfolio(withdrawal_amount, target_percentage, tolerance=0.01):
+# guess: answer of a neighbouring scenario, used by the 'brent' solver
+def find_required_portfolio(withdrawal_amount, target_percentage, tolerance=0.01, guess=None):
+    if solver == 'sorted':
+        return find_required_portfolios_sorted(withdrawal_amount, [target_percentage])[target_percentage]
+    if solver == 'brent':
+        return find_required_portfolio_brent(withdrawal_amount, target_percentage, guess, tolerance)
+
     low = 500000  # Lower bound for portfolio value
     high = 5000000  # Upper bound for portfolio value
     best_portfolio_value = (low + high) / 2
     portfolios_in_range = []  # To store portfolios within the tolerance range
+    iterations = 0
 
     while high - low > tolerance:
         mid = (low + high) / 2
-        percentage_above_zero = simulate_withdrawals(mid, withdrawal_amount)
+        iterations += 1
+        percentage_above_zero = simulate_withdrawals(mid, withdrawal_amount, (
+            target_percentage - 0.5, target_percentage, target_percentage + 0.5
+        ))
 
         # Check if the percentage is within the tolerance range of the target
         if abs(percentage_above_zero - target_percentage) <= 0.5:
@@ -63,29 +189,74 @@ def find_required_portfolio(withdrawal_amount, target_percentage, tolerance=0.01
     else:
         optimal_portfolio_value = best_portfolio_value  # If no values in range, return the last best value
 
+    get_tracer().event('bisection', target=target_percentage, iterations=iterations,
+                       in_range=len(portfolios_in_range), result=optimal_portfolio_value)
     return optimal_portfolio_value
 
 # Find the required portfolio value for multiple target percentages
 def find_portfolio_values_for_targets(target_percentages, withdrawal_amount):
+    tracer = get_tracer()
+    if solver == 'sorted':
+        with tracer.stage('find_required_portfolios_sorted'):
+            portfolio_values = find_required_portfolios_sorted(withdrawal_amount, target_percentages)
+        for target, portfolio_value in portfolio_values.items():
+            print(f"Required Portfolio for {target}% success rate: ${portfolio_value:.2f}")
+        return portfolio_values
+
     portfolio_values = {}
     for target in target_percentages:
         print(f"\nCalculating for target: {target}%")
-        portfolio_value = find_required_portfolio(withdrawal_amount, target)
+        with tracer.stage('find_required_portfolio'):
+            portfolio_value = find_required_portfolio(withdrawal_amount, target)
         portfolio_values[target] = portfolio_value
         print(f"Required Portfolio for {target}% success rate: ${portfolio_value:.2f}")
     
     return portfolio_values
 
-# Specify the withdrawal amount for 29 years
-withdrawal_amount = 45991  # Example withdrawal rate
+# Function to solve the required portfolio value for each value of one setting
+# (e.g. 'fee', 'inflation' or 'n_years'), in increasing order; with the 'brent'
+# solver each search starts from the answer for the previous value
+def sweep_required_portfolios(withdrawal_amount, target_percentage, parameter, values):
+    original_value = globals()[parameter]
+    portfolio_values = {}
+    portfolio_value = None
+    try:
+        for value in sorted(values):
+            globals()[parameter] = value
+            print(f"\nCalculating for {parameter} = {value}")
+            portfolio_value = find_required_portfolio(withdrawal_amount, target_percentage, guess=portfolio_value)
+            portfolio_values[value] = portfolio_value
+    finally:
+        globals()[parameter] = original_value
+    return portfolio_values
+
+# Main execution block
+if __name__ == '__main__':
+    # Specify the withdrawal amount for 29 years
+    withdrawal_amount = 45991  # Example withdrawal rate
 
-# Specify target percentages (75%, 85%, and 95%)
-target_percentages = [85, 75, 95]
+    # Specify target percentages (75%, 85%, and 95%)
+    target_percentages = [85, 75, 95]
+
+    if trace_file:
+        set_tracer(Tracer())
+
+    # Run the process for all targets to calculate required portfolio values
+    # (or reuse the results of an identical earlier run)
+    if use_cache and seed is not None:
+        key = cache_key('sim2.find_portfolio_values_for_targets', cache_inputs(),
+                        target_percentages=target_percentages, withdrawal_amount=withdrawal_amount)
+        portfolio_values = default_cache.get_or_compute(
+            key, lambda: find_portfolio_values_for_targets(target_percentages, withdrawal_amount)
+        )
+    else:
+        portfolio_values = find_portfolio_values_for_targets(target_percentages, withdrawal_amount)
 
-# Run the process for all targets to calculate required portfolio values
-portfolio_values = find_portfolio_values_for_targets(target_percentages, withdrawal_amount)
+    # Display the results
+    print("\nFinal required portfolio values for each target:")
+    for target, value in portfolio_values.items():
+        print(f"{target}% success rate: ${value:.2f}")
 
-# Display the results
-print("\nFinal required portfolio values for each target:")
-for target, value in portfolio_values.items():
-    print(f"{target}% success rate: ${value:.2f}")
\ No newline at end of file
+    if trace_file:
+        get_tracer().export(trace_file)
+        print(f"Trace saved to '{trace_file}'")
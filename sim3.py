@@ -3,13 +3,26 @@ import pandas as pd
 import multiprocessing as mp
 import warnings
 
+import guardrail
+from engine import success_rate, withdrawals_for_success_rates
+from generators import make_generator
+from estimators import (
+    adaptive_success_rate, estimate_success_rate, sample_returns, sampling_methods, sequential_success_rate
+)
+from instrument import Tracer, get_tracer, set_tracer
+from policies import make_policy
+from results_store import ResultStore, average_withdrawals, year_fields
+from scenario import Scenario
+from scenario_bank import get_returns
+from shared_array import SharedArray
+from sketch import QuantileSketch
+
 # Suppress warnings for cleaner output
 warnings.filterwarnings('ignore')
 
 # Investment Parameters
 mean_return = 0.1048        # Expected annual return (10.48%)
 fee = 0.012                 # Annual fee (1.2%)
-mean_return -= fee          # Adjusted mean return after fees
 std_dev = 0.1272            # Annual standard deviation (12.72%)
 
 # Simulation Parameters
@@ -25,56 +38,209 @@ upper_threshold = 95        # Upper threshold for withdrawal adjustment (%)
 withdrawal_cap = None       # Maximum withdrawal amount (set to None if no cap)
 withdrawal_floor = None     # Minimum withdrawal amount (set to None if no floor)
 
+# Withdrawal Policy (see policies.py)
+withdrawal_policy = 'probability'   # 'probability' (the guardrails above), 'guyton_klinger', 'constant_percentage',
+                                    # 'vpw' or 'constant'; the others need no success rates and run fully vectorized
+policy_rate = None                  # Initial withdrawal rate, share of the balance ('constant_percentage') or
+                                    # expected real return ('vpw'); None uses the policy's default
+
+# Return Model (see generators.py)
+return_model = 'normal'     # 'normal', 'lognormal', 'student_t', 'bootstrap' or 'regime'
+t_df = 5                    # Degrees of freedom for 'student_t'
+history_file = None         # CSV of annual nominal returns for 'bootstrap' (fee and inflation are subtracted)
+block_size = 5              # Years per bootstrap block
+portfolio = None            # Multi-asset portfolio.Portfolio (import it to set one) used instead of mean_return / std_dev, e.g.
+                            # Portfolio(means=(0.1048, 0.045), std_devs=(0.1272, 0.06),
+                            #           correlation=((1, 0.1), (0.1, 1)), weights=(0.6, 0.4))
+
 # Inner Simulation Parameter
 n_inner_simulations = 100   # Reduced number of simulations for success rate calculations
-
-# Output File
+inner_estimator = 'mc'      # 'mc', 'antithetic', 'sobol' (requires scipy) or 'control' (see estimators.py)
+inner_ci_width = None       # e.g. 2.0: add batches of inner simulations until the 95% confidence interval
+                            # of each success rate is at most this many percentage points wide
+max_inner_simulations = 6400  # Upper limit on inner simulations per success rate in the adaptive mode
+inner_early_exit = True     # Simulate inner paths in batches and stop once the success rate is clearly
+                            # outside the thresholds / target band being tested ('mc' estimator only)
+inner_batch_size = 25       # Inner simulations per batch
+inner_confidence = 99.9     # Confidence level (%) for stopping early
+
+# Scenario Bank Seed
+seed = 2024                 # Inner success rates reuse the same simulated returns (None draws fresh ones)
+
+# Success-Rate Surface Parameters
+use_success_surface = True      # Look up inner success rates in a precomputed table instead of re-simulating
+n_surface_simulations = 10000   # Number of simulations used to build the table
+success_surface = None          # Loaded on first use (cached on disk in surface.cache_dir)
+
+# Batched Mode
+batched = True              # Advance all simulations together one year at a time instead of one pool task per path
+
+# Parallel Chunks
+chunk_size = 500            # Simulations per chunk; each chunk gets its own random stream spawned from seed,
+                            # so results depend on seed and chunk_size but not on the number of processes
+processes = None            # Worker processes (None: one per CPU)
+
+# Shared Outputs
+shared_outputs = False      # Pool workers write each chunk's results in place into arrays shared with this
+                            # process (output_dir's memory-mapped .npy files, or shared memory when write_results
+                            # is off) instead of returning them pickled. Batched chunks then also run on the pool,
+                            # reading their returns from one (years x simulations) matrix in shared memory.
+
+# Output Files
+write_results = True                              # Keep per-(path, year) results in output_dir
+output_dir = 'retirement_simulation_results'     # Per-(path, year) results, written chunk by chunk
+output_format = 'npy'                             # 'npy' (memory-mapped) or 'parquet' (requires pyarrow)
+write_excel = True                                # Write the percentile summaries to output_file
+excel_details = False                             # Also write the per-simulation sheets (small runs only)
+percentile_method = 'sketch'                      # 'sketch' (constant memory) or 'exact' (from output_dir)
 output_file = 'retirement_simulation_results.xlsx'
+trace_file = None                                 # e.g. 'sim3_trace.json': write call counts, stage times and
+                                                  # guardrail firing per year (main process only)
 
 # Function definitions...
 
+# True when returns come from the single-asset normal model
+def normal_returns():
+    return return_model == 'normal' and portfolio is None
+
+# Function to build the generator of real returns for the return model or portfolio
+# start_year: first year of the returns in the retirement calendar (sets the
+# glide path allocation of a portfolio)
+def get_return_generator(start_year=0):
+    if portfolio is not None:
+        return portfolio.generator(fee + inflation_rate, start_year, n_years_total)
+    return make_generator(
+        return_model, mean_return - fee - inflation_rate, std_dev, t_df, history_file, block_size,
+        history_shift=fee + inflation_rate,
+    )
+
+# Function to generate returns for the success rate calculations over the
+# last n_years of retirement
+# Without a seed, draws from rng (a chunk's stream) when given, otherwise from
+# the global NumPy random state
+def get_simulated_returns(n_years, n_paths, sampling='mc', rng=None):
+    if not normal_returns():
+        if inner_estimator != 'mc':
+            raise ValueError(f"inner_estimator = {inner_estimator!r} requires the single-asset normal return model")
+        generator = get_return_generator(start_year=n_years_total - n_years)
+        if seed is None:
+            return generator.generate(n_years, n_paths, rng)
+        return get_returns(mean_return, std_dev, fee, inflation_rate, n_years, n_paths, seed, generator=generator)
+    if seed is None:
+        return sample_returns(mean_return - fee - inflation_rate, std_dev, n_years, n_paths, sampling, rng)
+    return get_returns(mean_return, std_dev, fee, inflation_rate, n_years, n_paths, seed, sampling)
+
+# Function to collect the parameters above into a Scenario
+def current_scenario():
+    return Scenario(
+        mean=mean_return, std_dev=std_dev, fee=fee, inflation=inflation_rate,
+        n_years=n_years_total, n_simulations=n_simulations, seed=seed, chunk_size=chunk_size,
+        initial_portfolio=initial_portfolio, target_success_rate=target_success_rate,
+        lower_threshold=lower_threshold, upper_threshold=upper_threshold,
+        withdrawal_cap=withdrawal_cap, withdrawal_floor=withdrawal_floor,
+        n_surface_simulations=n_surface_simulations, return_model=return_model, t_df=t_df,
+        history_file=history_file, block_size=block_size, portfolio=portfolio,
+        withdrawal_policy=withdrawal_policy, policy_rate=policy_rate,
+    )
+
+# Function to build the withdrawal policy other than the probability rule
+def get_policy():
+    return make_policy(withdrawal_policy, current_scenario(), policy_rate)
+
+# Function to pick the adjust function of a batched run: the policy (built
+# once for the run) or the probability guardrails, whose inner simulations
+# draw from rng (the chunk's stream) when there is no seed
+def get_adjust(rng=None):
+    if withdrawal_policy == 'probability':
+        return lambda balances, years_remaining, withdrawals: adjust_withdrawals(
+            balances, years_remaining, withdrawals, rng
+        )
+    return get_policy()
+
+# Function to load the success-rate surface for the current market assumptions
+def get_success_surface():
+    global success_surface
+    if success_surface is None:
+        success_surface = guardrail.scenario_surface(current_scenario())
+    return success_surface
+
 # Function to calculate the initial withdrawal amount for Year 1
 def calculate_initial_withdrawal():
-    def simulate_withdrawals(withdrawal_amount):
-        excel_style_returns = (mean_return - inflation_rate) + std_dev * np.random.normal(
-            0, 1, (n_years_total, n_simulations)
-        )
-        ending_values = []
+    if withdrawal_policy != 'probability':
+        return get_policy().initial_withdrawal(initial_portfolio, n_years_total)
 
-        for simulation in range(n_simulations):
-            portfolio_value = initial_portfolio
+    excel_style_returns = get_simulated_returns(n_years_total, n_simulations)
 
-            for year in range(n_years_total):
-                portfolio_value -= withdrawal_amount
-                if portfolio_value <= 0:
-                    portfolio_value = 0
-                    break
-                annual_return = excel_style_returns[year, simulation]
-                portfolio_value *= (1 + annual_return)
+    # Read the target success rate off the sorted per-path maximum withdrawals
+    optimal_withdrawal = withdrawals_for_success_rates(
+        excel_style_returns, initial_portfolio, target_success_rate
+    )
 
-            ending_values.append(portfolio_value)
+    return optimal_withdrawal
 
-        percentage_above_zero = np.mean(np.array(ending_values) > 0) * 100
-        return percentage_above_zero
+# Function to simulate portfolio over the remaining years and calculate success rate
+# Given boundaries (success rates in %), stops early once the rate is clearly above or below each
+# rng: stream of the calling chunk, used for the draws when there is no seed
+def calculate_success_rate(portfolio_balance, withdrawal_amount, years_remaining, boundaries=None, rng=None):
+    tracer = get_tracer()
+    tracer.count('inner_simulations', years_remaining=years_remaining)
+    real_mean = mean_return - fee - inflation_rate
+
+    if inner_ci_width is not None:
+        if not normal_returns():
+            raise ValueError("inner_ci_width requires the single-asset normal return model")
+        # Adaptive: the same seeded batches for every call, as with the scenario bank
+        rng = np.random.default_rng(seed) if seed is not None else rng
+        rate, _, n_paths = adaptive_success_rate(
+            portfolio_balance, withdrawal_amount, real_mean, std_dev, years_remaining, inner_ci_width,
+            inner_estimator, max_paths=max_inner_simulations, rng=rng,
+        )
+        tracer.count('inner_paths', n_paths, years_remaining=years_remaining)
+        return rate
 
-    # Binary search to find the optimal initial withdrawal amount
+    # Use reduced number of simulations for inner calculations
+    excel_style_returns = get_simulated_returns(
+        years_remaining, n_inner_simulations, sampling_methods[inner_estimator], rng
+    )
+    if boundaries is not None and inner_early_exit and inner_estimator == 'mc':
+        rate, n_paths = sequential_success_rate(
+            excel_style_returns, portfolio_balance, withdrawal_amount, boundaries, inner_batch_size, inner_confidence
+        )
+        tracer.count('inner_paths', n_paths, years_remaining=years_remaining)
+        return rate
+
+    tracer.count('inner_paths', n_inner_simulations, years_remaining=years_remaining)
+    if inner_estimator == 'mc':
+        return success_rate(excel_style_returns, portfolio_balance, withdrawal_amount)
+    rate, _ = estimate_success_rate(
+        excel_style_returns, portfolio_balance, withdrawal_amount, inner_estimator, real_mean, std_dev
+    )
+    return rate
+
+# Function to search for the withdrawal amount that meets the target success rate
+def search_withdrawal(portfolio_balance, years_remaining, rng=None):
+    # Binary search to find the adjusted withdrawal amount
     low = 0
-    high = initial_portfolio
+    high = portfolio_balance
     tolerance = 0.01
     tolerance_percentage = 0.5
-    max_iterations = 20  # Limit the number of iterations
+    max_iterations = 10  # Limit the number of iterations
 
     withdrawals_in_range = []
+    iterations = 0
 
     for _ in range(max_iterations):
         mid = (low + high) / 2
-        success_rate = simulate_withdrawals(mid)
+        iterations += 1
+        new_success_rate = calculate_success_rate(portfolio_balance, mid, years_remaining, (
+            target_success_rate - tolerance_percentage, target_success_rate, target_success_rate + tolerance_percentage
+        ), rng)
 
-        if abs(success_rate - target_success_rate) <= tolerance_percentage:
+        if abs(new_success_rate - target_success_rate) <= tolerance_percentage:
             withdrawals_in_range.append(mid)
             break  # Accept the withdrawal amount within tolerance
 
-        if success_rate > target_success_rate:
+        if new_success_rate > target_success_rate:
             low = mid
         else:
             high = mid
@@ -82,71 +248,38 @@ def calculate_initial_withdrawal():
         if high - low < tolerance:
             break
 
+    get_tracer().count('search_iterations', iterations, years_remaining=years_remaining)
     if withdrawals_in_range:
-        optimal_withdrawal = np.mean(withdrawals_in_range)
-    else:
-        optimal_withdrawal = mid
-
-    return optimal_withdrawal
-
-# Function to simulate portfolio over the remaining years and calculate success rate
-def calculate_success_rate(portfolio_balance, withdrawal_amount, years_remaining):
-    # Use reduced number of simulations for inner calculations
-    excel_style_returns = (mean_return - inflation_rate) + std_dev * np.random.normal(
-        0, 1, (years_remaining, n_inner_simulations)
-    )
-    ending_values = []
-
-    for simulation in range(n_inner_simulations):
-        portfolio_value = portfolio_balance
-
-        for year in range(years_remaining):
-            portfolio_value -= withdrawal_amount
-            if portfolio_value <= 0:
-                portfolio_value = 0
-                break
-            annual_return = excel_style_returns[year, simulation]
-            portfolio_value *= (1 + annual_return)
-
-        ending_values.append(portfolio_value)
-
-    success_rate = np.mean(np.array(ending_values) > 0) * 100
-    return success_rate
+        return np.mean(withdrawals_in_range)
+    return mid
 
 # Function to adjust withdrawal amount based on success rate
-def adjust_withdrawal(portfolio_balance, years_remaining, current_withdrawal):
-    success_rate = calculate_success_rate(portfolio_balance, current_withdrawal, years_remaining)
+# policy: the run's withdrawal policy (see get_policy) unless it is 'probability'
+# rng: stream of the calling chunk for inner simulations without a seed
+def adjust_withdrawal(portfolio_balance, years_remaining, current_withdrawal, policy=None, rng=None):
+    if withdrawal_policy != 'probability':
+        policy = get_policy() if policy is None else policy
+        return policy(np.array([portfolio_balance]), years_remaining, np.array([current_withdrawal]))[0]
+
+    if use_success_surface:
+        surface = get_success_surface()
+        success_rate = surface.success_rate(portfolio_balance, current_withdrawal, years_remaining)
+    else:
+        success_rate = calculate_success_rate(
+            portfolio_balance, current_withdrawal, years_remaining, (lower_threshold, upper_threshold), rng
+        )
 
+    tracer = get_tracer()
+    tracer.count('guardrail_checks', years_remaining=years_remaining)
     if success_rate < lower_threshold or success_rate > upper_threshold:
-        # Binary search to find the adjusted withdrawal amount
-        low = 0
-        high = portfolio_balance
-        tolerance = 0.01
-        tolerance_percentage = 0.5
-        max_iterations = 10  # Limit the number of iterations
-
-        withdrawals_in_range = []
-
-        for _ in range(max_iterations):
-            mid = (low + high) / 2
-            new_success_rate = calculate_success_rate(portfolio_balance, mid, years_remaining)
-
-            if abs(new_success_rate - target_success_rate) <= tolerance_percentage:
-                withdrawals_in_range.append(mid)
-                break  # Accept the withdrawal amount within tolerance
-
-            if new_success_rate > target_success_rate:
-                low = mid
-            else:
-                high = mid
-
-            if high - low < tolerance:
-                break
-
-        if withdrawals_in_range:
-            adjusted_withdrawal = np.mean(withdrawals_in_range)
+        tracer.count('guardrail_fired', years_remaining=years_remaining)
+        if use_success_surface:
+            # Inverse lookup of the withdrawal that gives the target success rate
+            adjusted_withdrawal = surface.withdrawal_for_success_rate(
+                portfolio_balance, target_success_rate, years_remaining
+            )
         else:
-            adjusted_withdrawal = mid
+            adjusted_withdrawal = search_withdrawal(portfolio_balance, years_remaining, rng)
 
         # Apply withdrawal cap and floor if specified
         if withdrawal_cap is not None:
@@ -158,8 +291,31 @@ def adjust_withdrawal(portfolio_balance, years_remaining, current_withdrawal):
     else:
         return current_withdrawal
 
-# Function to run a single simulation (for multiprocessing)
-def run_single_simulation(args):
+# Function to adjust the withdrawal amounts of many simulations at once under
+# the probability guardrails (other policies are called directly, see get_adjust)
+def adjust_withdrawals(portfolio_balances, years_remaining, current_withdrawals, rng=None):
+    if not use_success_surface:
+        return np.array([
+            adjust_withdrawal(balance, years_remaining, withdrawal, rng=rng)
+            for balance, withdrawal in zip(portfolio_balances, current_withdrawals)
+        ])
+
+    return guardrail.adjust_withdrawals(
+        current_scenario(), get_success_surface(), portfolio_balances, years_remaining, current_withdrawals
+    )
+
+# Function to run many simulations in lockstep, one year at a time
+# Years after a path is depleted are left as NaN, like the missing columns of
+# a depleted path in run_single_simulation.
+def run_batched_simulations(initial_withdrawal, n_paths, rng=None):
+    return guardrail.run_batched_simulations(
+        current_scenario(), initial_withdrawal, n_paths, get_adjust(rng), rng
+    )
+
+# Function to run a single simulation
+# Draws from rng when given, otherwise from the global NumPy random state
+# policy: the run's withdrawal policy (see adjust_withdrawal)
+def run_single_simulation(args, rng=None, policy=None):
     simulation, initial_withdrawal = args
     portfolio_balance = initial_portfolio
     years_remaining = n_years_total
@@ -167,6 +323,11 @@ def run_single_simulation(args):
     simulation_data = {}
     annual_returns = []  # To store annual returns for CAGR calculation
 
+    # Other return models and portfolios draw the whole path at once (bootstrap
+    # blocks and regimes span several years)
+    if not normal_returns():
+        path_returns = get_return_generator().generate(n_years_total, 1, rng)[:, 0]
+
     for year in range(1, n_years_total + 1):
         # Record the beginning balance
         begin_balance = portfolio_balance
@@ -187,7 +348,11 @@ def run_single_simulation(args):
             break  # Portfolio depleted, exit the year loop
 
         # Apply investment return
-        annual_return = (mean_return - inflation_rate) + std_dev * np.random.normal(0, 1)
+        if not normal_returns():
+            annual_return = path_returns[year - 1]
+        else:
+            draw = rng.normal(0, 1) if rng is not None else np.random.normal(0, 1)
+            annual_return = (mean_return - fee - inflation_rate) + std_dev * draw
         ending_balance = net_begin * (1 + annual_return)
 
         # Store the annual return for CAGR calculation
@@ -198,7 +363,7 @@ def run_single_simulation(args):
 
         # Adjust withdrawal amount for next year if necessary
         if years_remaining > 0:
-            withdrawal_amount = adjust_withdrawal(ending_balance, years_remaining, withdrawal_amount)
+            withdrawal_amount = adjust_withdrawal(ending_balance, years_remaining, withdrawal_amount, policy, rng)
 
         # Record data for the current year
         simulation_data[f'Year {year} Begin Bal'] = begin_balance
@@ -221,79 +386,194 @@ def run_single_simulation(args):
 
     return simulation_data
 
+# Function to split the simulations into chunks with independent random streams
+def make_chunks(initial_withdrawal, n_paths):
+    return guardrail.make_chunks(current_scenario(), initial_withdrawal, n_paths)
+
+# Function to convert single-simulation dicts to the batched (years x simulations) layout
+def simulation_dicts_to_results(simulations):
+    results = {}
+    for field in year_fields:
+        results[field] = np.array([
+            [simulation_data.get(f'Year {year} {field}', np.nan) for simulation_data in simulations]
+            for year in range(1, n_years_total + 1)
+        ], dtype=float)
+    results['CAGR'] = np.array([simulation_data['CAGR'] for simulation_data in simulations], dtype=float)
+    return results
+
+# Function to run one chunk of single simulations (for multiprocessing)
+def run_simulation_chunk(args):
+    start, stop, initial_withdrawal, chunk_seed = args
+    rng = np.random.default_rng(chunk_seed)
+    policy = None if withdrawal_policy == 'probability' else get_policy()
+    simulations = [
+        run_single_simulation((simulation, initial_withdrawal), rng, policy) for simulation in range(start, stop)
+    ]
+    return simulation_dicts_to_results(simulations)
+
+# Function to run one chunk of simulations in lockstep
+def run_batched_chunk(args):
+    start, stop, initial_withdrawal, chunk_seed = args
+    return run_batched_simulations(initial_withdrawal, stop - start, np.random.default_rng(chunk_seed))
+
+# Function to generate every chunk's returns into one shared (years x simulations)
+# matrix (the same draws as each chunk makes from its own stream)
+def make_shared_returns(chunks):
+    returns = SharedArray((n_years_total, n_simulations))
+    generator = get_return_generator()
+    for start, stop, _, chunk_seed in chunks:
+        returns.array[:, start:stop] = generator.generate(n_years_total, stop - start, np.random.default_rng(chunk_seed))
+    return returns
+
+# Function to run one chunk in a pool worker, writing its results in place into store
+# (returns: the shared return matrix for batched chunks, None for single simulations)
+def run_shared_chunk(args):
+    start, stop, initial_withdrawal, chunk_seed, store, returns = args
+    try:
+        if returns is None:
+            store.write_chunk(start, run_simulation_chunk((start, stop, initial_withdrawal, chunk_seed)))
+        else:
+            # The chunk's outer draws are already in returns; inner draws get a child stream
+            guardrail.run_batched_simulations(
+                current_scenario(), initial_withdrawal, stop - start,
+                get_adjust(np.random.default_rng(chunk_seed.spawn(1)[0])),
+                returns=returns.array[:, start:stop], out=store.chunk_views(start, stop),
+            )
+            store.summarize_chunk(start, stop)
+    finally:
+        store.close()
+        if returns is not None:
+            returns.close()
+    return stop - start
+
 # Main execution block
 if __name__ == '__main__':
     # Suppress warnings for cleaner output
     warnings.filterwarnings('ignore')
 
+    tracer = set_tracer(Tracer()) if trace_file else get_tracer()
+    tracer.event('scenario', batched=batched, use_success_surface=use_success_surface,
+                 n_inner_simulations=n_inner_simulations, **current_scenario().to_dict())
+
     # Calculate the initial withdrawal amount
-    initial_withdrawal = calculate_initial_withdrawal()
+    with tracer.stage('initial_withdrawal'):
+        initial_withdrawal = calculate_initial_withdrawal()
     print(f"Calculated initial withdrawal amount: ${initial_withdrawal:.2f}")
 
-    # Prepare arguments for multiprocessing
-    args_list = [(simulation, initial_withdrawal) for simulation in range(n_simulations)]
-
-    # Run simulations in parallel
-    with mp.Pool(processes=mp.cpu_count()) as pool:
-        results = pool.map(run_single_simulation, args_list)
+    # Load the success-rate surface once so forked workers inherit it
+    if use_success_surface and withdrawal_policy == 'probability':
+        with tracer.stage('success_surface'):
+            get_success_surface()
 
-    # Convert the list of simulation data into a DataFrame
-    df_simulation_results = pd.DataFrame(results)
+    # Split the simulations into chunks with independent random streams
+    chunks = make_chunks(initial_withdrawal, n_simulations)
 
-    # Extract Annual Returns
-    # Get list of annual return columns
-    annual_return_columns = [col for col in df_simulation_results.columns if 'Year' in col and 'Return' in col]
-
-    # Extract those columns
-    df_annual_returns = df_simulation_results[annual_return_columns]
+    # Write each chunk to the columnar store and the percentile sketches as soon as it finishes
+    if shared_outputs:
+        if write_results and output_format != 'npy':
+            raise ValueError("shared_outputs requires output_format = 'npy'")
+        store = ResultStore(output_dir, n_simulations, n_years_total, output_format if write_results else 'shared')
+    else:
+        store = ResultStore(output_dir, n_simulations, n_years_total, output_format) if write_results else None
+    cagr_sketch = QuantileSketch()
+    withdrawal_sketch = QuantileSketch()
+
+    def record_chunk(start, results):
+        if store is not None:
+            store.write_chunk(start, results)
+        cagr_sketch.update(results['CAGR'])
+        withdrawal_sketch.update(average_withdrawals(results))
+
+    with tracer.stage('simulations'):
+        if shared_outputs:
+            # Workers write into the shared arrays; only the chunk sizes come back
+            shared_returns = make_shared_returns(chunks) if batched else None
+            try:
+                with mp.Pool(processes=processes or mp.cpu_count()) as pool:
+                    for _ in pool.imap_unordered(run_shared_chunk, [chunk + (store, shared_returns) for chunk in chunks]):
+                        pass
+            except BaseException:
+                # A failed run never reaches the close at the end; release the shared-memory results here
+                if not write_results:
+                    store.close()
+                raise
+            finally:
+                if shared_returns is not None:
+                    shared_returns.close()
+            cagr_sketch.update(store.path_summary('cagr'))
+            withdrawal_sketch.update(store.path_summary('average_withdrawal'))
+        elif batched:
+            # Run each chunk of simulations together in one process
+            for chunk in chunks:
+                record_chunk(chunk[0], run_batched_chunk(chunk))
+        else:
+            # Run chunks in parallel
+            with mp.Pool(processes=processes or mp.cpu_count()) as pool:
+                for chunk, results in zip(chunks, pool.imap(run_simulation_chunk, chunks)):
+                    record_chunk(chunk[0], results)
 
-    # Optionally, you can rename the columns to 'Year 1', 'Year 2', etc.
-    df_annual_returns.columns = [f'Year {i+1}' for i in range(len(annual_return_columns))]
+    if write_results:
+        store.close()
+        print(f"Simulation results saved to '{output_dir}'")
 
-    # Calculate CAGR Percentiles
-    cagr_values = df_simulation_results['CAGR']
+    # Calculate CAGR and Average Annual Withdrawal Percentiles
     percentiles = np.arange(0, 101, 1)
-    cagr_percentiles = np.percentile(cagr_values, percentiles)
+    if percentile_method == 'exact':
+        if store is None:
+            raise ValueError("percentile_method = 'exact' requires write_results or shared_outputs")
+        cagr_percentiles = store.percentiles('cagr', percentiles)
+        withdrawal_percentiles = store.percentiles('average_withdrawal', percentiles)
+    else:
+        cagr_percentiles = cagr_sketch.percentiles(percentiles)
+        withdrawal_percentiles = withdrawal_sketch.percentiles(percentiles)
+
     df_cagr_percentiles = pd.DataFrame({
         'Percentile': percentiles,
         'CAGR': cagr_percentiles * 100  # Convert to percentage
     })
-
-    # **Extract Annual Withdrawals and Prepare DataFrame**
-    # Get list of annual withdrawal columns
-    annual_withdrawal_columns = [col for col in df_simulation_results.columns if 'Year' in col and 'Withdrawal' in col]
-
-    # Extract those columns
-    df_withdrawals = df_simulation_results[annual_withdrawal_columns]
-
-    # Calculate the average withdrawal per simulation across all years
-    df_withdrawals['Average Withdrawal'] = df_withdrawals.mean(axis=1)
-
-    # Reorder columns to have 'Average Withdrawal' at the beginning
-    cols = ['Average Withdrawal'] + [col for col in df_withdrawals.columns if col != 'Average Withdrawal']
-    df_withdrawals = df_withdrawals[cols]
-
-    # **Calculate Percentiles for Average Annual Withdrawals**
-    average_withdrawals = df_withdrawals['Average Withdrawal'].values
-    withdrawal_percentiles = np.percentile(average_withdrawals, percentiles)
     df_withdrawal_percentiles = pd.DataFrame({
         'Percentile': percentiles,
         'Average Withdrawal': withdrawal_percentiles
     })
 
-    # Save the results to an Excel file with multiple sheets
-    with pd.ExcelWriter(output_file) as writer:
-        df_simulation_results.to_excel(writer, sheet_name='Simulations', index=False)
-        df_cagr_percentiles.to_excel(writer, sheet_name='CAGR Percentiles', index=False)
-        df_annual_returns.to_excel(writer, sheet_name='Annual Returns', index=False)
-        df_withdrawals.to_excel(writer, sheet_name='Annual Withdrawals', index=False)
-        df_withdrawal_percentiles.to_excel(writer, sheet_name='Withdrawal Percentiles', index=False)
+    if write_excel:
+        if excel_details and store is None:
+            raise ValueError("excel_details requires write_results or shared_outputs")
+
+        # Save the summaries (and optionally the per-simulation detail) to an Excel file
+        with pd.ExcelWriter(output_file) as writer:
+            df_cagr_percentiles.to_excel(writer, sheet_name='CAGR Percentiles', index=False)
+            df_withdrawal_percentiles.to_excel(writer, sheet_name='Withdrawal Percentiles', index=False)
+
+            if excel_details:
+                df_simulation_results = store.to_wide_dataframe()
+                df_simulation_results.to_excel(writer, sheet_name='Simulations', index=False)
 
-    print(f"Simulation results saved to '{output_file}'")
+                # Annual returns, with columns renamed to 'Year 1', 'Year 2', etc.
+                df_annual_returns = pd.DataFrame(
+                    store.year_field('Return'), columns=[f'Year {i+1}' for i in range(n_years_total)]
+                )
+                df_annual_returns.to_excel(writer, sheet_name='Annual Returns', index=False)
 
-    # Display the first few rows of the results
-    print(df_simulation_results.head())
+                # Annual withdrawals with the average withdrawal per simulation first
+                df_withdrawals = pd.DataFrame(
+                    store.year_field('Withdrawal'), columns=[f'Year {i+1} Withdrawal' for i in range(n_years_total)]
+                )
+                df_withdrawals.insert(0, 'Average Withdrawal', store.path_summary('average_withdrawal'))
+                df_withdrawals.to_excel(writer, sheet_name='Annual Withdrawals', index=False)
+
+        print(f"Summary saved to '{output_file}'")
+
+    # Display the percentile summaries
     print("\nCAGR Percentiles:")
     print(df_cagr_percentiles.head(10))
     print("\nWithdrawal Percentiles:")
-    print(df_withdrawal_percentiles.head(10))
\ No newline at end of file
+    print(df_withdrawal_percentiles.head(10))
+
+    # Release the shared-memory results
+    if store is not None and not write_results:
+        store.close()
+
+    if trace_file:
+        tracer.export(trace_file)
+        print(f"Trace saved to '{trace_file}'")
@@ -0,0 +1,97 @@
+import math
+
+import numpy as np
+
+# Streaming, mergeable quantile sketch with a bounded relative error.
+# Values are counted in logarithmically sized buckets (the DDSketch scheme):
+# every quantile it returns is within relative_accuracy of the true value at
+# that rank, for values whose magnitude is above min_value. Memory grows with
+# the log of the value range, not with the number of values, so percentile
+# tables can be built over any number of paths chunk by chunk. Sketches built
+# in different workers are combined with merge().
+
+
+class QuantileSketch:
+    def __init__(self, relative_accuracy=0.0005, min_value=1e-9):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+        self.positive = {}  # bucket index -> count
+        self.negative = {}  # bucket index of abs(value) -> count
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    # Function to add a chunk of values (NaNs are ignored)
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+
+        positive = values > self.min_value
+        negative = values < -self.min_value
+        self._add(self.positive, values[positive])
+        self._add(self.negative, -values[negative])
+        self.zero_count += int(len(values) - positive.sum() - negative.sum())
+
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def _add(self, buckets, values):
+        keys = np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+        unique_keys, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(unique_keys.tolist(), counts.tolist()):
+            buckets[key] = buckets.get(key, 0) + count
+
+    # Function to fold another sketch (e.g. from another worker) into this one
+    def merge(self, other):
+        if other.gamma != self.gamma or other.min_value != self.min_value:
+            raise ValueError("Can only merge sketches with the same accuracy settings")
+
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_buckets.items():
+                buckets[key] = buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    # Function to estimate quantiles (q between 0 and 1, scalar or array)
+    def quantile(self, q):
+        if self.count == 0:
+            raise ValueError("Cannot take quantiles of an empty sketch")
+
+        # Buckets in increasing order of value: negatives, zero, positives
+        negative_keys = sorted(self.negative, reverse=True)
+        positive_keys = sorted(self.positive)
+        counts = np.array(
+            [self.negative[key] for key in negative_keys] + [self.zero_count]
+            + [self.positive[key] for key in positive_keys]
+        )
+        midpoint = 2 / (1 + self.gamma)
+        values = np.concatenate([
+            -midpoint * self.gamma ** np.array(negative_keys, dtype=float),
+            [0.0],
+            midpoint * self.gamma ** np.array(positive_keys, dtype=float),
+        ])
+
+        # Same ranks as np.percentile: q * (count - 1)
+        ranks = np.asarray(q, dtype=float) * (self.count - 1)
+        buckets = np.searchsorted(np.cumsum(counts), ranks, side='right')
+        return np.clip(values[np.minimum(buckets, len(values) - 1)], self.min, self.max)[()]
+
+    # Function to estimate percentiles (0 to 100), like np.percentile
+    def percentiles(self, percentiles):
+        return self.quantile(np.asarray(percentiles, dtype=float) / 100)
+
+    def __len__(self):
+        return self.count
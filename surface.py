@@ -0,0 +1,99 @@
+import hashlib
+import os
+
+import numpy as np
+
+from engine import annuity_factor_table, remaining_annuity_factor_table
+from scenario_bank import get_returns
+
+# Precomputed success-rate surface for the guardrail re-solves in sim3.py.
+# With withdrawals taken at the start of each year, the success rate of a
+# constant withdrawal depends only on the balance / withdrawal ratio and the
+# years remaining: a path survives when the ratio exceeds its annuity factor.
+# The surface stores, for every horizon, the quantile function of the annuity
+# factors on a fine percentile grid. Success rates are read off it by
+# interpolating ratio -> percentile, and target withdrawals by interpolating
+# percentile -> ratio, so a nested Monte Carlo run becomes a table lookup.
+
+# Default directory for surfaces cached on disk
+cache_dir = '.mclarlo_cache'
+
+# Percentile grid of the table (0% to 100% in 0.1% increments)
+percentile_grid = np.linspace(0, 100, 1001)
+
+
+class SuccessSurface:
+    def __init__(self, percentiles, ratio_quantiles):
+        self.percentiles = percentiles
+        self.ratio_quantiles = ratio_quantiles  # (n_years, n_percentiles), row h - 1 for h years
+        self.n_years = ratio_quantiles.shape[0]
+
+    # Function to look up the success rate (%) of withdrawing a constant amount
+    # for the remaining years; works on scalars or arrays of paths
+    def success_rate(self, portfolio_balance, withdrawal_amount, years_remaining):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = np.divide(portfolio_balance, withdrawal_amount, dtype=float)
+        ratios = np.where(np.asarray(portfolio_balance) > 0, ratios, 0)
+        return self._lookup(ratios, years_remaining, self.ratio_quantiles, self.percentiles)
+
+    # Function to look up the constant withdrawal that gives the target success
+    # rate (%) for the remaining years
+    def withdrawal_for_success_rate(self, portfolio_balance, target_percentage, years_remaining):
+        ratios = self._lookup(target_percentage, years_remaining, self.percentiles, self.ratio_quantiles)
+        # Survival needs balance / withdrawal strictly above the factor, so step
+        # just past it (with one year left every factor is exactly 1)
+        return np.maximum(portfolio_balance, 0) / np.nextafter(ratios, np.inf)
+
+    def _lookup(self, values, years_remaining, xp, fp):
+        values, years_remaining = np.broadcast_arrays(
+            np.asarray(values, dtype=float), np.asarray(years_remaining)
+        )
+        results = np.empty(values.shape)
+        for years in np.unique(years_remaining):
+            rows = years_remaining == years
+            row_xp = xp if xp.ndim == 1 else xp[years - 1]
+            row_fp = fp if fp.ndim == 1 else fp[years - 1]
+            results[rows] = np.interp(values[rows], row_xp, row_fp)
+        return results[()]
+
+
+# Function to build the surface from a (years x simulations) return matrix;
+# every horizon is a prefix of the same simulated paths, or with
+# remaining=True the last years of them (for returns that depend on the
+# calendar year, such as a portfolio glide path)
+def build_success_surface(returns, remaining=False):
+    factors = remaining_annuity_factor_table(returns) if remaining else annuity_factor_table(returns)
+    with np.errstate(invalid='ignore'):
+        ratio_quantiles = np.quantile(factors, percentile_grid / 100, axis=1).T
+    # Paths depleted by a return at or below -100% need an unbounded ratio
+    ratio_quantiles = np.nan_to_num(ratio_quantiles, nan=np.inf)
+    return SuccessSurface(percentile_grid, ratio_quantiles)
+
+
+# Function to load the surface for a set of market assumptions from the disk
+# cache, building and saving it on the first request
+# generator: return generator (generators.py) for models other than the normal one
+# remaining: see build_success_surface
+def load_success_surface(mean, std_dev, fee, inflation, n_years, n_simulations, seed, directory=None, generator=None,
+                         remaining=False):
+    directory = cache_dir if directory is None else directory
+    key = (mean, std_dev, fee, inflation, n_years, n_simulations, seed, len(percentile_grid))
+    key = key if generator is None else key + (generator.key,)
+    key = repr(key + ('remaining',) if remaining else key)
+    path = os.path.join(directory, f"surface-{hashlib.sha1(key.encode()).hexdigest()}.npz")
+
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return SuccessSurface(data['percentiles'], data['ratio_quantiles'])
+
+    returns = get_returns(mean, std_dev, fee, inflation, n_years, n_simulations, seed, generator=generator)
+    surface = build_success_surface(returns, remaining)
+
+    # Write to a temporary file first so concurrent readers never see a partial file
+    os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        np.savez(f, percentiles=surface.percentiles, ratio_quantiles=surface.ratio_quantiles)
+    os.replace(temp_path, path)
+
+    return surface
@@ -0,0 +1,205 @@
+import math
+
+from engine import success_rate
+
+# Warm-started solves across neighbouring scenarios.
+#
+# With common random numbers the success rate of a scenario is a fixed,
+# monotone (step) function of the withdrawal or starting balance, so a
+# bracketed root finder (Brent's method: inverse quadratic interpolation and
+# secant steps, falling back to bisection) reaches the target in a handful
+# of evaluations where the fixed-bounds bisection takes about 25. A sweep
+# orders the scenarios by the parameters that vary between them and starts
+# each search from a narrow bracket around the previous scenario's answer.
+
+# Relative width of the first warm-start bracket around the previous answer
+warm_start_step = 0.02
+
+
+# Function to find a root of function between low and high with Brent's method
+# f_low / f_high: function values at low and high, if already known
+# Stops when |function| <= f_tolerance or the bracket is narrower than x_tolerance.
+# Returns the root and the number of function evaluations.
+def find_root(function, low, high, f_low=None, f_high=None, x_tolerance=0.01, f_tolerance=0.0, max_iterations=100):
+    evaluations = 0
+    if f_low is None:
+        f_low, evaluations = function(low), evaluations + 1
+    if f_high is None:
+        f_high, evaluations = function(high), evaluations + 1
+    if abs(f_low) <= f_tolerance:
+        return float(low), evaluations
+    if abs(f_high) <= f_tolerance:
+        return float(high), evaluations
+    if (f_low > 0) == (f_high > 0):
+        raise ValueError(f"The root is not bracketed by {low} and {high}")
+
+    a, b, fa, fb = low, high, f_low, f_high
+    c, fc = b, fb
+    d = e = b - a
+    for _ in range(max_iterations):
+        # Keep the root between b and c
+        if (fb > 0) == (fc > 0):
+            c, fc = a, fa
+            d = e = b - a
+        # b is the best estimate so far
+        if abs(fc) < abs(fb):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+
+        tolerance = 2 * 2.2e-16 * abs(b) + 0.5 * x_tolerance
+        midpoint = 0.5 * (c - b)
+        if abs(midpoint) <= tolerance or abs(fb) <= f_tolerance:
+            return float(b), evaluations
+
+        if abs(e) >= tolerance and abs(fa) > abs(fb):
+            # Secant (a == c) or inverse quadratic interpolation step
+            s = fb / fa
+            if a == c:
+                p, q = 2 * midpoint * s, 1 - s
+            else:
+                q, r = fa / fc, fb / fc
+                p = s * (2 * midpoint * q * (q - r) - (b - a) * (r - 1))
+                q = (q - 1) * (r - 1) * (s - 1)
+            if p > 0:
+                q = -q
+            p = abs(p)
+            if 2 * p < min(3 * midpoint * q - abs(tolerance * q), abs(e * q)):
+                e, d = d, p / q
+            else:
+                d = e = midpoint
+        else:
+            d = e = midpoint
+
+        a, fa = b, fb
+        b += d if abs(d) > tolerance else math.copysign(tolerance, midpoint)
+        fb, evaluations = function(b), evaluations + 1
+
+    return float(b), evaluations
+
+
+# Function to find a bracket [low, high] with a sign change of function,
+# starting at guess and widening geometrically, within [lower_limit, upper_limit]
+# If the function has the same sign at both limits (or no sign change turns up
+# within max_evaluations), returns the last bracket tried without one.
+# Returns (low, f_low, high, f_high, evaluations).
+def expand_bracket(function, guess, step=warm_start_step, lower_limit=0.0, upper_limit=math.inf, max_evaluations=60):
+    limits = {}  # Function values at the limits, once evaluated
+
+    def evaluate(x):
+        value = function(x)
+        if x == lower_limit or x == upper_limit:
+            limits[x] = value
+        return value
+
+    low = max(guess * (1 - step), lower_limit)
+    high = min(guess * (1 + step), upper_limit)
+    f_low, f_high = evaluate(low), evaluate(high)
+    evaluations = 2
+
+    while (f_low > 0) == (f_high > 0) and f_low != 0 and f_high != 0:
+        # Both limits seen: the whole range is the bracket, with or without a sign change
+        if len(limits) == 2:
+            return lower_limit, limits[lower_limit], upper_limit, limits[upper_limit], evaluations
+        if evaluations >= max_evaluations:
+            break
+        step *= 2
+        # Move towards the side where the function is closer to zero
+        if abs(f_high) < abs(f_low) and high < upper_limit or low <= lower_limit:
+            low, f_low = high, f_high
+            high = min(guess * (1 + step), upper_limit)
+            if high <= low:
+                high = min(low * (1 + step), upper_limit)
+            f_high = evaluate(high)
+        else:
+            high, f_high = low, f_low
+            low = max(guess * (1 - step), lower_limit)
+            if low >= high:
+                low = max(high * (1 - step), lower_limit)
+            f_low = evaluate(low)
+        evaluations += 1
+
+    return low, f_low, high, f_high, evaluations
+
+
+# Function to solve success(x) = target for x, warm-started from guess if given,
+# otherwise searching the whole of bounds
+# success: success rate (%) as a function of x; f_tolerance in percentage
+# points (e.g. one path: 100 / n_simulations)
+# If the target is not reached anywhere within bounds, x is the bound whose
+# success rate is closest to it.
+# Returns x and the number of success-rate evaluations.
+def solve_for_target(success, target, bounds, guess=None, x_tolerance=0.01, f_tolerance=0.0):
+    def function(x):
+        return success(x) - target
+
+    if guess is None:
+        low, high = bounds
+        f_low, f_high = function(low), function(high)
+        evaluations = 2
+    else:
+        low, f_low, high, f_high, evaluations = expand_bracket(
+            function, guess, lower_limit=bounds[0], upper_limit=bounds[1]
+        )
+
+    # Target out of reach within bounds: like the bisection, settle on the nearer bound
+    if (f_low > 0) == (f_high > 0) and f_low != 0 and f_high != 0:
+        return float(low if abs(f_low) < abs(f_high) else high), evaluations
+
+    root, more_evaluations = find_root(function, low, high, f_low, f_high, x_tolerance, f_tolerance)
+    return root, evaluations + more_evaluations
+
+
+# Function to solve the withdrawal with a target success rate for a Scenario
+def solve_withdrawal(scenario, target, guess=None, bounds=(0.0, None), x_tolerance=0.01):
+    returns = scenario.returns()
+    upper = scenario.initial_portfolio if bounds[1] is None else bounds[1]
+    return solve_for_target(
+        lambda withdrawal: success_rate(returns, scenario.initial_portfolio, withdrawal),
+        target, (bounds[0], upper), guess, x_tolerance, f_tolerance=100 / scenario.n_simulations,
+    )
+
+
+# Function to solve the starting balance with a target success rate for a Scenario
+def solve_required_portfolio(scenario, target, withdrawal_amount=None, guess=None, bounds=(0.0, None),
+                             x_tolerance=0.01):
+    returns = scenario.returns()
+    withdrawal_amount = scenario.withdrawal_amount if withdrawal_amount is None else withdrawal_amount
+    upper = withdrawal_amount * scenario.n_years * 10 if bounds[1] is None else bounds[1]
+    return solve_for_target(
+        lambda balance: success_rate(returns, balance, withdrawal_amount),
+        target, (bounds[0], upper), guess, x_tolerance, f_tolerance=100 / scenario.n_simulations,
+    )
+
+
+# Function to order scenarios by the fields that differ between them
+# (numbers in increasing order, anything else by its text)
+def sweep_order(scenarios):
+    rows = [scenario.to_dict() for scenario in scenarios]
+    columns = []
+    for name in rows[0] if rows else ():
+        values = [row[name] for row in rows]
+        if any(repr(value) != repr(values[0]) for value in values):
+            numeric = all(isinstance(value, (int, float)) for value in values)
+            columns.append(values if numeric else [repr(value) for value in values])
+    return sorted(range(len(rows)), key=lambda index: tuple(column[index] for column in columns))
+
+
+# Function to solve many neighbouring scenarios, each warm-started from the
+# answer of the previous one in sweep order
+# solve: 'withdrawal' or 'portfolio'; target: success rate (%), defaults to
+# each scenario's target_success_rate
+# Returns (answer, evaluations) per scenario, in the order given.
+def sweep(scenarios, solve='withdrawal', target=None):
+    solvers = {'withdrawal': solve_withdrawal, 'portfolio': solve_required_portfolio}
+    if solve not in solvers:
+        raise ValueError(f"Unknown sweep solve: {solve!r} (choose from {', '.join(solvers)})")
+
+    results = [None] * len(scenarios)
+    guess = None
+    for index in sweep_order(scenarios):
+        scenario = scenarios[index]
+        scenario_target = scenario.target_success_rate if target is None else target
+        answer, evaluations = solvers[solve](scenario, scenario_target, guess=guess)
+        results[index] = (answer, evaluations)
+        guess = answer
+    return results
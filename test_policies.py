@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from policies import (
+    ConstantPercentage, ConstantWithdrawal, GuytonKlinger, VariablePercentage, make_policies, policy_specs, run_policies,
+)
+from scenario import Scenario
+
+# Behavioural tests for the withdrawal policies and run_policies on fixed
+# returns (run with: python -m pytest)
+
+
+# Function to build (years x paths) returns of one rate
+def flat_returns(rate, n_years=10, n_paths=3):
+    return np.full((n_years, n_paths), float(rate))
+
+
+def test_vpw_spends_down_without_depleting():
+    scenario = Scenario(n_years=10)
+    result = run_policies(scenario, {'vpw': VariablePercentage(0.0)}, returns=flat_returns(0.0))['vpw']
+    assert not result['depleted'].any()
+    assert result['ending_balance'] == pytest.approx(0, abs=1e-6)
+    assert result['average_withdrawal'] == pytest.approx(scenario.initial_portfolio / 10)
+
+
+def test_guyton_klinger_cut_raise_and_preservation():
+    policy = GuytonKlinger(0.05, threshold=0.2, adjustment=0.1, preservation_years=15)
+    balances = np.array([500000.0, 1000000.0, 2000000.0])  # Rates of 10%, 5% and 2.5%
+    prior = np.full(3, 50000.0)
+    np.testing.assert_allclose(policy(balances, 20, prior), [45000, 50000, 55000])
+
+    # No cuts in the last preservation_years years; raises still apply
+    np.testing.assert_allclose(policy(balances, 15, prior), [50000, 50000, 55000])
+
+
+def test_floor_and_cap():
+    policy = ConstantPercentage(0.04, floor=30000, cap=50000)
+    np.testing.assert_allclose(policy(np.array([100000.0, 1000000.0, 5000000.0]), 10, None), [30000, 40000, 50000])
+    assert GuytonKlinger(0.05, cap=45000).initial_withdrawal(1000000, 30) == 45000
+
+
+def test_run_policies_depletion():
+    scenario = Scenario(n_years=10)
+    policies = {'low': ConstantWithdrawal(amount=50000), 'high': ConstantWithdrawal(amount=150000)}
+    results = run_policies(scenario, policies, returns=flat_returns(0.0))
+    assert not results['low']['depleted'].any()
+    assert results['high']['depleted'].all()
+    # Six full withdrawals, then nothing left for the seventh year
+    assert results['high']['min_withdrawal'] == pytest.approx(0)
+    assert results['high']['average_withdrawal'] == pytest.approx(6 * 150000 / 7)
+
+
+def test_policy_specs():
+    assert policy_specs(['vpw', 'constant']) == (('vpw', None), ('constant', None))
+    specs = policy_specs({'vpw': 0.03, 'gk_4': {'policy': 'guyton_klinger', 'rate': 0.04, 'threshold': 0.25}})
+    assert specs == (('vpw', 0.03), ('gk_4', (('policy', 'guyton_klinger'), ('rate', 0.04), ('threshold', 0.25))))
+
+    # Pairs (e.g. from a scenario written out as JSON) give the same specs
+    assert policy_specs([[label, spec if not isinstance(spec, tuple) else [list(item) for item in spec]]
+                         for label, spec in specs]) == specs
+
+    policies = make_policies(specs, Scenario())
+    assert isinstance(policies['gk_4'], GuytonKlinger)
+    assert (policies['gk_4'].initial_rate, policies['gk_4'].threshold) == (0.04, 0.25)
+    assert policies['vpw'].expected_return == 0.03
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError, match='Unknown withdrawal policy'):
+        make_policies(['bogus'], Scenario())
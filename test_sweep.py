@@ -0,0 +1,51 @@
+import pytest
+
+import sim1
+import sim2
+from sweep import expand_bracket, solve_for_target
+
+# Regression tests for the warm-started root searches when the answer lies
+# outside the search bounds (run with: python -m pytest)
+
+
+# Function to set sim1 / sim2 globals for a test and restore them afterwards
+@pytest.fixture
+def small_run(monkeypatch):
+    for module in (sim1, sim2):
+        monkeypatch.setattr(module, 'solver', 'brent')
+        monkeypatch.setattr(module, 'n_simulations', 500)
+
+
+def test_expand_bracket_stops_at_the_limits():
+    low, f_low, high, f_high, evaluations = expand_bracket(
+        lambda x: 90 - x * 1e-5, 95000, lower_limit=10000, upper_limit=100000
+    )
+    assert (low, high) == (10000, 100000)
+    assert f_low > 0 and f_high > 0
+    assert evaluations < 60
+
+
+def test_solve_for_target_settles_on_the_nearer_bound():
+    success = lambda x: 100 - x * 1e-5
+    assert solve_for_target(success, 10, (10000, 100000), guess=95000)[0] == 100000
+    assert solve_for_target(success, 10, (10000, 100000))[0] == 100000
+    assert solve_for_target(success, 99.99, (10000, 100000), guess=20000)[0] == 10000
+
+
+def test_solve_for_target_inside_bounds():
+    root, _ = solve_for_target(lambda x: 100 - x * 1e-3, 50, (10000, 100000), guess=90000)
+    assert root == pytest.approx(50000, abs=0.01)
+
+
+def test_brent_sweep_past_the_bounds(small_run):
+    optimal_withdrawals = sim1.sweep_optimal_withdrawals(85, 'mean', [0.1048, 0.20])
+    assert 10000 < optimal_withdrawals[0.1048] < 100000
+    assert optimal_withdrawals[0.20] == 100000
+
+
+def test_brent_cold_start_past_the_bounds(small_run, monkeypatch):
+    monkeypatch.setattr(sim1, 'n_years', 10)
+    assert sim1.find_optimal_withdrawal(85) == 100000
+
+    monkeypatch.setattr(sim2, 'n_years', 60)
+    assert sim2.find_required_portfolio(400000, 85) == 5000000